@@ -0,0 +1,195 @@
+"""Composite gridded fields by the phase of a climate index.
+
+Each time step is given a category, e.g. El Nino or La Nina from the sign of
+the SOI, and the mean, variance and count of every grid cell is computed for
+each category in a single pass over the time axis. The data are read a chunk
+of time steps at a time, so only one chunk is ever held in memory. Within a
+chunk the time steps are sorted by category and reduced segment by segment,
+and the chunk statistics are merged into running totals with the parallel
+variance update of Chan et al.
+"""
+
+# Import modules
+from itertools import combinations
+from typing import Optional, Sequence
+import numpy as np
+import pandas as pd
+import xarray
+import indices
+
+
+def categorize(
+    series: pd.Series,
+    thresholds: Sequence[float] = (0.0,),
+    labels: Optional[Sequence[str]] = ("El Nino", "La Nina"),
+) -> pd.Series:
+    """Assign a category to each value of an index.
+
+    Args:
+        series (pd.Series): the index values.
+        thresholds (sequence): the ascending values separating the
+            categories. A single threshold of 0 splits the index by its sign.
+        labels (sequence): a name for each category, one more than the
+            number of thresholds. The defaults name the SOI phases.
+
+    Returns:
+        pd.Series: the categorical series, missing where the index is missing.
+    """
+    bins = [-np.inf] + list(thresholds) + [np.inf]
+    if labels is None:
+        labels = [f"[{lower}, {upper})" for lower, upper in zip(bins[:-1], bins[1:])]
+
+    # Values equal to a threshold go in the category above it
+    return pd.cut(series, bins=bins, labels=list(labels), right=False)
+
+
+class _RunningStats:
+    """Running count, mean and sum of squared deviations per category."""
+
+    def __init__(self, n_categories: int, shape: tuple):
+        self.count = np.zeros((n_categories,) + shape)
+        self.mean = np.zeros((n_categories,) + shape)
+        self.m2 = np.zeros((n_categories,) + shape)
+
+    def update(self, codes: np.ndarray, values: np.ndarray):
+        """Merge a chunk of values with their category codes.
+
+        Args:
+            codes (np.ndarray): the category code of each time step.
+            values (np.ndarray): the values, with time as the first axis.
+        """
+        # Sort the time steps so each category is one contiguous segment
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        values = values[order]
+        present, starts, lengths = np.unique(codes, return_index=True, return_counts=True)
+
+        # Segment sums of the valid values
+        valid = np.isfinite(values)
+        filled = np.where(valid, values, 0.0)
+        count = np.add.reduceat(valid, starts, axis=0).astype(np.float64)
+        total = np.add.reduceat(filled, starts, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, total / count, 0.0)
+
+        # Segment sums of squared deviations from the chunk means
+        deviation = np.where(valid, filled - np.repeat(mean, lengths, axis=0), 0.0)
+        m2 = np.add.reduceat(deviation ** 2, starts, axis=0)
+
+        # Merge with the running statistics
+        old_count = self.count[present]
+        new_count = old_count + count
+        delta = mean - self.mean[present]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(new_count > 0, count / new_count, 0.0)
+        self.mean[present] += delta * weight
+        self.m2[present] += m2 + delta ** 2 * old_count * weight
+        self.count[present] = new_count
+
+
+def composite(
+    data_array: xarray.DataArray,
+    categories: pd.Series,
+    chunk_size: int = 120,
+) -> xarray.Dataset:
+    """Composite a gridded field by category in one pass over time.
+
+    Args:
+        data_array (xarray.DataArray): the field, with a time dimension. It
+            may be lazily loaded, since only one chunk is read at a time.
+        categories (pd.Series): the category of each month, e.g. from
+            categorize. It is aligned to the field's time axis by month, and
+            time steps without a category are skipped.
+        chunk_size (int): the number of time steps to read at a time.
+
+    Returns:
+        xarray.Dataset: the mean, variance and count of each category, and
+            the Welch t-statistic and degrees of freedom of the difference of
+            means for each pair of categories.
+    """
+    data_array = data_array.transpose("time", ...)
+    categories = pd.Series(pd.Categorical(categories), index=categories.index)
+    names = list(categories.cat.categories)
+
+    # Look up the category code of each time step
+    aligned = indices.align_to_time(categories.cat.codes.astype(float), data_array["time"])
+    codes = aligned.fillna(-1).to_numpy().astype(int)
+
+    # Accumulate the statistics a chunk at a time
+    stats = _RunningStats(len(names), data_array.shape[1:])
+    for start in range(0, data_array.sizes["time"], chunk_size):
+        chunk_codes = codes[start:start + chunk_size]
+        keep = chunk_codes >= 0
+        if not keep.any():
+            continue
+        chunk = data_array.isel(time=slice(start, start + chunk_size)).values
+        stats.update(chunk_codes[keep], np.asarray(chunk, dtype=np.float64)[keep])
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = np.where(stats.count > 1, stats.m2 / (stats.count - 1), np.nan)
+        mean = np.where(stats.count > 0, stats.mean, np.nan)
+
+    # Build the output dataset on the field's grid
+    dims = ("category",) + data_array.dims[1:]
+    coords = {dim: data_array[dim] for dim in data_array.dims[1:] if dim in data_array.coords}
+    coords["category"] = names
+    composite_dataset = xarray.Dataset(
+        {
+            "mean": (dims, mean, data_array.attrs),
+            "variance": (dims, variance),
+            "count": (dims, stats.count.astype(np.int64)),
+        },
+        coords=coords,
+    )
+
+    # Welch t-statistics for the difference of each pair of means
+    pairs = list(combinations(range(len(names)), 2))
+    if pairs:
+        t_stats, dofs = [], []
+        for i, j in pairs:
+            se_i = variance[i] / stats.count[i]
+            se_j = variance[j] / stats.count[j]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                t_stats.append((mean[i] - mean[j]) / np.sqrt(se_i + se_j))
+                dofs.append(
+                    (se_i + se_j) ** 2
+                    / (se_i ** 2 / (stats.count[i] - 1) + se_j ** 2 / (stats.count[j] - 1))
+                )
+        pair_dims = ("pair",) + data_array.dims[1:]
+        composite_dataset["t_statistic"] = (pair_dims, np.array(t_stats))
+        composite_dataset["degrees_of_freedom"] = (pair_dims, np.array(dofs))
+        composite_dataset = composite_dataset.assign_coords(
+            pair=[f"{names[i]} - {names[j]}" for i, j in pairs]
+        )
+
+    return composite_dataset
+
+
+def composite_dataset(
+    dataset: xarray.Dataset,
+    categories: pd.Series,
+    var_names: Optional[Sequence[str]] = None,
+    chunk_size: int = 120,
+) -> xarray.Dataset:
+    """Composite several variables of a dataset by category.
+
+    Args:
+        dataset (xarray.Dataset): the dataset, with a time dimension.
+        categories (pd.Series): the category of each month.
+        var_names (sequence): the variables to composite, or None for every
+            variable with a time dimension.
+        chunk_size (int): the number of time steps to read at a time.
+
+    Returns:
+        xarray.Dataset: the composite statistics, with each output variable
+            prefixed by the name of its input variable.
+    """
+    if var_names is None:
+        var_names = [name for name in dataset.data_vars if "time" in dataset[name].dims]
+
+    composites = []
+    for var_name in var_names:
+        result = composite(dataset[var_name], categories, chunk_size=chunk_size)
+        composites.append(result.rename({name: f"{var_name}_{name}" for name in result.data_vars}))
+
+    return xarray.merge(composites)
@@ -0,0 +1,203 @@
+"""Empirical orthogonal function (EOF) analysis of gridded fields.
+
+The field is read a chunk of time steps at a time and each chunk updates an
+incremental singular value decomposition, so memory use depends on the grid
+size, the chunk size and the number of modes but not on the record length.
+Each grid cell is weighted by the square root of the cosine of its latitude
+so that the covariance is area weighted. Once fitted, new months can be
+projected onto the EOFs, or used to update them, one chunk at a time.
+"""
+
+# Import modules
+from typing import Optional
+import numpy as np
+import xarray
+from sklearn.decomposition import IncrementalPCA
+
+
+def monthly_climatology(data_array: xarray.DataArray, chunk_size: int = 120) -> xarray.DataArray:
+    """Compute the mean of each calendar month a chunk at a time.
+
+    Args:
+        data_array (xarray.DataArray): the field, with a time dimension.
+        chunk_size (int): the number of time steps to read at a time.
+
+    Returns:
+        xarray.DataArray: the mean of each month, with a month dimension.
+    """
+    data_array = data_array.transpose("time", ...)
+    sums = np.zeros((12,) + data_array.shape[1:])
+    counts = np.zeros((12,) + data_array.shape[1:])
+
+    # Accumulate the sums and counts of each month
+    months = data_array["time.month"].values - 1
+    for start in range(0, data_array.sizes["time"], chunk_size):
+        chunk = data_array.isel(time=slice(start, start + chunk_size)).values
+        chunk = np.asarray(chunk, dtype=np.float64)
+        valid = np.isfinite(chunk)
+        np.add.at(sums, months[start:start + chunk_size], np.where(valid, chunk, 0.0))
+        np.add.at(counts, months[start:start + chunk_size], valid)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        climatology = np.where(counts > 0, sums / counts, np.nan)
+
+    coords = {dim: data_array[dim] for dim in data_array.dims[1:] if dim in data_array.coords}
+    coords["month"] = np.arange(1, 13)
+
+    return xarray.DataArray(
+        climatology,
+        dims=("month",) + data_array.dims[1:],
+        coords=coords,
+        attrs=data_array.attrs,
+    )
+
+
+class EOF:
+    """Class for incremental EOF analysis of a lat/lon field."""
+
+    def __init__(
+        self,
+        n_components: int = 10,
+        chunk_size: int = 120,
+        climatology: Optional[xarray.DataArray] = None,
+    ):
+        """Initialize the EOF class.
+
+        Args:
+            n_components (int): the number of modes to keep.
+            chunk_size (int): the number of time steps to read at a time.
+                It must be at least the number of modes.
+            climatology (xarray.DataArray): a monthly climatology, e.g. from
+                monthly_climatology, to remove before the decomposition. If
+                None, only the time mean is removed.
+        """
+        if chunk_size < n_components:
+            raise ValueError("The chunk size must be at least the number of modes.")
+
+        # Set the class properties
+        self.n_components = n_components
+        self.chunk_size = chunk_size
+        self.climatology = climatology
+        self.pca = IncrementalPCA(n_components=n_components)
+
+        # The grid is set by the first data fitted
+        self.lat = None
+        self.lon = None
+        self.weights = None
+        self.valid = None
+
+    def _prepare(self, data_array: xarray.DataArray) -> np.ndarray:
+        """Flatten a chunk to (time, valid cells) weighted anomalies."""
+        if self.climatology is not None:
+            data_array = data_array.groupby("time.month") - self.climatology
+        values = np.asarray(data_array.transpose("time", "lat", "lon").values, dtype=np.float64)
+        values = values.reshape(values.shape[0], -1)
+
+        # Set the grid, weights and valid cells from the first chunk
+        if self.lat is None:
+            self.lat = data_array["lat"].copy()
+            self.lon = data_array["lon"].copy()
+            lat = np.deg2rad(data_array["lat"].values)
+            weights = np.sqrt(np.clip(np.cos(lat), 0, None))
+            self.weights = np.repeat(weights, data_array.sizes["lon"])
+            self.valid = np.isfinite(values).all(axis=0)
+
+        values = values[:, self.valid] * self.weights[self.valid]
+
+        # Missing values in later chunks are set to the running mean
+        missing = ~np.isfinite(values)
+        if missing.any():
+            fill = self.pca.mean_ if hasattr(self.pca, "mean_") else np.nanmean(values, axis=0)
+            values = np.where(missing, fill, values)
+
+        return values
+
+    def _chunks(self, data_array: xarray.DataArray):
+        """Yield the field a chunk of time steps at a time."""
+        for start in range(0, data_array.sizes["time"], self.chunk_size):
+            yield data_array.isel(time=slice(start, start + self.chunk_size))
+
+    def partial_fit(self, data_array: xarray.DataArray) -> "EOF":
+        """Update the EOFs with more time steps.
+
+        Args:
+            data_array (xarray.DataArray): the new time steps, at least as
+                many as the number of modes.
+
+        Returns:
+            EOF: the updated EOF object.
+        """
+        self.pca.partial_fit(self._prepare(data_array))
+
+        return self
+
+    def fit(self, data_array: xarray.DataArray) -> "EOF":
+        """Fit the EOFs to a field one chunk at a time.
+
+        A final chunk shorter than the number of modes is merged into the
+        chunk before it.
+
+        Args:
+            data_array (xarray.DataArray): the field, with time, lat and lon
+                dimensions.
+
+        Returns:
+            EOF: the fitted EOF object.
+        """
+        n_time = data_array.sizes["time"]
+        for start in range(0, n_time, self.chunk_size):
+            stop = start + self.chunk_size
+            if n_time - stop < self.n_components:
+                self.partial_fit(data_array.isel(time=slice(start, None)))
+                break
+            self.partial_fit(data_array.isel(time=slice(start, stop)))
+
+        return self
+
+    def project(self, data_array: xarray.DataArray) -> xarray.DataArray:
+        """Project a field onto the EOFs to get the principal components.
+
+        Args:
+            data_array (xarray.DataArray): the field, on the same grid as the
+                data the EOFs were fitted to.
+
+        Returns:
+            xarray.DataArray: the principal component time series, with time
+                and mode dimensions.
+        """
+        pcs = [self.pca.transform(self._prepare(chunk)) for chunk in self._chunks(data_array)]
+
+        return xarray.DataArray(
+            np.concatenate(pcs),
+            dims=("time", "mode"),
+            coords={"time": data_array["time"], "mode": np.arange(1, self.n_components + 1)},
+            name="pc",
+        )
+
+    @property
+    def eofs(self) -> xarray.DataArray:
+        """xarray.DataArray: the EOF patterns, with mode, lat and lon dimensions.
+
+        The patterns are the unit length eigenvectors of the area weighted
+        covariance, with cells that had missing values set missing.
+        """
+        patterns = np.full((self.n_components, self.valid.size), np.nan)
+        patterns[:, self.valid] = self.pca.components_
+        shape = (self.n_components, self.lat.size, self.lon.size)
+
+        return xarray.DataArray(
+            patterns.reshape(shape),
+            dims=("mode", "lat", "lon"),
+            coords={"mode": np.arange(1, self.n_components + 1), "lat": self.lat, "lon": self.lon},
+            name="eof",
+        )
+
+    @property
+    def explained_variance_ratio(self) -> xarray.DataArray:
+        """xarray.DataArray: the fraction of the total variance in each mode."""
+        return xarray.DataArray(
+            self.pca.explained_variance_ratio_,
+            dims="mode",
+            coords={"mode": np.arange(1, self.n_components + 1)},
+            name="explained_variance_ratio",
+        )
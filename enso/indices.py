@@ -0,0 +1,208 @@
+"""Download, parse and cache monthly climate index time series.
+
+The Climate Prediction Center publishes indices like the SOI as text files
+with a row per year and a column per month, split into blocks such as the
+anomaly and standardized values. The parsed monthly series is cached as a
+typed binary file keyed by the ETag of the source file, so it is only
+downloaded and parsed again when NOAA updates it.
+"""
+
+# Import modules
+import glob
+import hashlib
+import os
+from typing import Optional
+import numpy as np
+import pandas as pd
+import requests
+
+# Source URLs of the indices published in the year by month layout
+INDEX_URLS = {
+    "soi": "https://www.cpc.ncep.noaa.gov/data/indices/soi",
+    "darwin": "https://www.cpc.ncep.noaa.gov/data/indices/darwin",
+    "tahiti": "https://www.cpc.ncep.noaa.gov/data/indices/tahiti",
+}
+
+# Value used in the source files for missing months
+MISSING_VALUE = -999.9
+
+
+def parse_index_text(text: str, block: str = "STANDARDIZED") -> pd.Series:
+    """Parse a year by month index product into a monthly series.
+
+    Rows are found by their leading four digit year, and values are matched
+    as numbers rather than split on whitespace, so fields that run together
+    like -999.9-999.9 are still read correctly.
+
+    Args:
+        text (str): the contents of the index text file.
+        block (str): the heading of the block of data to read, e.g.
+            "ANOMALY" or "STANDARDIZED".
+
+    Returns:
+        pd.Series: the index values with a monthly DatetimeIndex.
+    """
+    lines = pd.Series(text.splitlines())
+
+    # Find the block heading, and the run of year rows that follows it
+    headings = np.flatnonzero(lines.str.contains(block, case=False, regex=False).to_numpy())
+    if headings.size == 0:
+        raise ValueError(f"No block named {block} found in the index file.")
+    is_row = lines.str.match(r"\s*\d{4}\s").to_numpy(dtype=bool, copy=True)
+    is_row[: headings[0] + 1] = False
+    if not is_row.any():
+        raise ValueError(f"No rows of data found in the {block} block.")
+    start = int(np.argmax(is_row))
+    is_break = ~is_row & (lines.str.strip().str.len() > 0).to_numpy()
+    is_break[:start] = False
+    stop = int(np.argmax(is_break)) if is_break.any() else lines.size
+    rows = lines[start:stop][is_row[start:stop]]
+
+    # Pull out the year and each monthly value
+    years = rows.str.slice(0, 6).str.strip().astype(int).to_numpy()
+    values = rows.str.slice(6).str.extractall(r"(-?\d+\.\d+)")[0].astype(np.float64)
+    values = values.unstack().reindex(index=rows.index, columns=range(12)).to_numpy()
+
+    # Convert from wide to long with a monthly date index
+    time = pd.to_datetime({
+        "year": np.repeat(years, 12),
+        "month": np.tile(np.arange(1, 13), years.size),
+        "day": 1,
+    })
+    series = pd.Series(values.ravel(), index=pd.DatetimeIndex(time, name="time"))
+    series = series.where(series > MISSING_VALUE + 0.05).dropna().astype(np.float32)
+
+    return series.sort_index()
+
+
+def _cache_path(cache_dir: str, name: str, block: str, etag: str) -> str:
+    """Build the path to a cached series from the source ETag."""
+    digest = hashlib.sha1(etag.encode("utf-8")).hexdigest()[:16]
+
+    return os.path.join(cache_dir, f"{name}_{block.lower()}_{digest}.npz")
+
+
+def save_series(series: pd.Series, path: str):
+    """Write a monthly series as a typed binary file.
+
+    Args:
+        series (pd.Series): the series with a DatetimeIndex.
+        path (str): the path to the file to write.
+    """
+    np.savez(
+        path,
+        time=series.index.values.astype("datetime64[ns]"),
+        values=series.to_numpy(dtype=np.float32),
+        name=np.array(series.name or ""),
+    )
+
+
+def load_series(path: str) -> pd.Series:
+    """Read a monthly series written by save_series.
+
+    Args:
+        path (str): the path to the file.
+
+    Returns:
+        pd.Series: the series with a DatetimeIndex.
+    """
+    with np.load(path) as data:
+        name = str(data["name"]) or None
+        return pd.Series(data["values"], index=pd.DatetimeIndex(data["time"], name="time"), name=name)
+
+
+def read_index(
+    name: str = "soi",
+    block: str = "STANDARDIZED",
+    cache_dir: str = "./data/indices/",
+    url: Optional[str] = None,
+) -> pd.Series:
+    """Read a monthly climate index, using the cache when it is current.
+
+    The source ETag is checked with a HEAD request, and the index is only
+    downloaded and parsed when no cache file exists for that ETag. If the
+    source cannot be reached, the most recent cache file is used instead.
+
+    Args:
+        name (str): the name of the index, a key of INDEX_URLS.
+        block (str): the heading of the block of data to read.
+        cache_dir (str): the directory holding cached series.
+        url (str): the source URL, to read an index not in INDEX_URLS.
+
+    Returns:
+        pd.Series: the index values with a monthly DatetimeIndex.
+    """
+    url = url or INDEX_URLS[name]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Check the ETag of the source file
+    try:
+        response = requests.head(url, timeout=30)
+        response.raise_for_status()
+        etag = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    except requests.RequestException:
+        cached = glob.glob(os.path.join(cache_dir, f"{name}_{block.lower()}_*.npz"))
+        if not cached:
+            raise
+        return load_series(max(cached, key=os.path.getmtime))
+
+    # Use the cached series if the source has not changed
+    if etag is not None:
+        path = _cache_path(cache_dir, name, block, etag)
+        if os.path.exists(path):
+            return load_series(path)
+
+    # Download and parse the index
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    series = parse_index_text(response.content.decode("utf-8"), block=block)
+    series.name = name.upper()
+    series.index.name = "time"
+
+    # Cache the series under the ETag of the downloaded file
+    etag = response.headers.get("ETag") or response.headers.get("Last-Modified") or etag
+    if etag is not None:
+        save_series(series, _cache_path(cache_dir, name, block, etag))
+
+    return series
+
+
+def read_soi(cache_dir: str = "./data/indices/") -> pd.Series:
+    """Read the standardized Southern Oscillation Index.
+
+    Args:
+        cache_dir (str): the directory holding cached series.
+
+    Returns:
+        pd.Series: the monthly SOI with a DatetimeIndex.
+    """
+    return read_index("soi", block="STANDARDIZED", cache_dir=cache_dir)
+
+
+def align_to_time(series: pd.Series, time) -> pd.Series:
+    """Align a monthly index to the time axis of a dataset.
+
+    Monthly datasets stamp each month differently, e.g. mid-month for OLR
+    and the first of the month for NCEP, so both are matched by month.
+
+    Args:
+        series (pd.Series): the monthly index with a DatetimeIndex.
+        time: the time values of the dataset, e.g. dataset["time"].
+
+    Returns:
+        pd.Series: the index values indexed by the dataset time, with NaN for
+            months that are missing from the index.
+    """
+    time = pd.DatetimeIndex(np.asarray(time))
+    by_month = pd.Series(series.to_numpy(), index=series.index.to_period("M"))
+    aligned = by_month.reindex(time.to_period("M"))
+    aligned.index = time
+
+    return aligned.rename(series.name)
+
+
+if __name__ == "__main__":
+
+    # Read the SOI, downloading it only if it has changed
+    soi = read_soi()
+    print(soi.tail())
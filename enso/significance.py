@@ -0,0 +1,268 @@
+"""Monte Carlo significance testing of index regressions on gridded fields.
+
+The regression of a field on an index is compared against regressions on
+surrogate index series that keep the autocorrelation of the index but not
+its relationship to the field. Surrogates are either moving block
+bootstraps or phase randomizations of the index. They are made in batches,
+and each batch is regressed on the whole field with one matrix product per
+lag. Batches are spread over a process pool, each seeded from its own child
+of one seed sequence, so the results do not depend on the number of
+workers. Field significance is assessed by controlling the false discovery
+rate across the grid cells, following Wilks (2016).
+"""
+
+# Import modules
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+import numpy as np
+import pandas as pd
+import xarray
+import indices
+
+
+def block_bootstrap(x: np.ndarray, n_surrogates: int, block_length: int, rng: np.random.Generator) -> np.ndarray:
+    """Make surrogates by joining randomly chosen blocks of a series.
+
+    Args:
+        x (np.ndarray): the 1D series.
+        n_surrogates (int): the number of surrogates to make.
+        block_length (int): the length of each block in time steps.
+        rng (np.random.Generator): the random number generator.
+
+    Returns:
+        np.ndarray: an (n_surrogates, len(x)) array of surrogates.
+    """
+    n_time = x.size
+    n_blocks = -(-n_time // block_length)
+
+    # Pick the start of each block, then gather the blocks end to end
+    starts = rng.integers(0, n_time - block_length + 1, size=(n_surrogates, n_blocks))
+    positions = (starts[:, :, None] + np.arange(block_length)).reshape(n_surrogates, -1)
+
+    return x[positions[:, :n_time]]
+
+
+def phase_randomize(x: np.ndarray, n_surrogates: int, rng: np.random.Generator) -> np.ndarray:
+    """Make surrogates with the power spectrum of a series and random phases.
+
+    Args:
+        x (np.ndarray): the 1D series.
+        n_surrogates (int): the number of surrogates to make.
+        rng (np.random.Generator): the random number generator.
+
+    Returns:
+        np.ndarray: an (n_surrogates, len(x)) array of surrogates.
+    """
+    n_time = x.size
+    spectrum = np.fft.rfft(x - x.mean())
+
+    # Randomize every phase except the mean and, for even lengths, Nyquist
+    phases = rng.uniform(0, 2 * np.pi, size=(n_surrogates, spectrum.size))
+    phases[:, 0] = 0
+    if n_time % 2 == 0:
+        phases[:, -1] = 0
+
+    return np.fft.irfft(spectrum * np.exp(1j * phases), n=n_time, axis=1) + x.mean()
+
+
+def false_discovery_rate(p_values: np.ndarray, alpha: float = 0.05) -> np.ndarray:
+    """Find which p-values are significant under the Benjamini-Hochberg test.
+
+    Args:
+        p_values (np.ndarray): the p-values, with NaN for cells not tested.
+        alpha (float): the false discovery rate to control.
+
+    Returns:
+        np.ndarray: a boolean array, true where the null is rejected.
+    """
+    flat = p_values.ravel()
+    tested = np.flatnonzero(np.isfinite(flat))
+    significant = np.zeros(flat.shape, dtype=bool)
+    if tested.size == 0:
+        return significant.reshape(p_values.shape)
+
+    # Reject every p-value up to the largest one under the BH line
+    order = tested[np.argsort(flat[tested])]
+    below = flat[order] <= alpha * np.arange(1, order.size + 1) / order.size
+    if below.any():
+        significant[order[: np.flatnonzero(below)[-1] + 1]] = True
+
+    return significant.reshape(p_values.shape)
+
+
+def _lag_windows(n_time: int, max_lag: int):
+    """Find the field time slices paired with the fixed index window."""
+    return [slice(max_lag + lag, n_time - max_lag + lag) for lag in range(-max_lag, max_lag + 1)]
+
+
+def _regression_slopes(x: np.ndarray, field: np.ndarray, max_lag: int) -> Iterator[np.ndarray]:
+    """Regress the field on one or more index series at each lag in turn.
+
+    The slopes are made one lag at a time, so that only a single lag's
+    slopes are held in memory for a batch of surrogates.
+
+    Args:
+        x (np.ndarray): an (n_series, n_time) array of index series.
+        field (np.ndarray): an (n_time, n_cells) array of the field.
+        max_lag (int): the largest lag in time steps.
+
+    Yields:
+        np.ndarray: an (n_series, n_cells) array of slopes for each lag,
+            from -max_lag to max_lag.
+    """
+    n_time = field.shape[0]
+
+    # The index window is the same at every lag
+    x = x[:, max_lag:n_time - max_lag]
+    x = x - x.mean(axis=1, keepdims=True)
+    sxx = (x ** 2).sum(axis=1)[:, None]
+
+    # Centering the index is enough for the slope, so the field is not centered
+    for window in _lag_windows(n_time, max_lag):
+        yield (x @ field[window]) / sxx
+
+
+# Arrays shared with each worker process, set once by the initializer
+_shared = {}
+
+
+def _init_worker(
+    index: np.ndarray,
+    field: np.ndarray,
+    observed: np.ndarray,
+    max_lag: int,
+    method: str,
+    block_length: int,
+):
+    """Store the arrays every batch needs in the worker process."""
+    _shared.update(
+        index=index,
+        field=field,
+        observed=np.abs(observed),
+        max_lag=max_lag,
+        method=method,
+        block_length=block_length,
+    )
+
+
+def _run_batch(seed: np.random.SeedSequence, n_surrogates: int) -> np.ndarray:
+    """Count the surrogate slopes at least as large as the observed slopes.
+
+    Args:
+        seed (np.random.SeedSequence): the seed for this batch.
+        n_surrogates (int): the number of surrogates in the batch.
+
+    Returns:
+        np.ndarray: an (n_lags, n_cells) array of exceedance counts.
+    """
+    rng = np.random.default_rng(seed)
+    index = _shared["index"]
+
+    # Make the batch of surrogate index series
+    if _shared["method"] == "block":
+        surrogates = block_bootstrap(index, n_surrogates, _shared["block_length"], rng)
+    elif _shared["method"] == "phase":
+        surrogates = phase_randomize(index, n_surrogates, rng)
+    else:
+        raise ValueError(f"Unknown surrogate method {_shared['method']}.")
+
+    # Regress the field on every surrogate at once, counting one lag at a time
+    observed = _shared["observed"]
+    counts = np.zeros(observed.shape, dtype=np.int64)
+    for lag, slopes in enumerate(_regression_slopes(surrogates, _shared["field"], _shared["max_lag"])):
+        counts[lag] = (np.abs(slopes) >= observed[lag]).sum(axis=0)
+
+    return counts
+
+
+def regression_significance(
+    index: pd.Series,
+    data_array: xarray.DataArray,
+    max_lag: int = 0,
+    n_surrogates: int = 1000,
+    batch_size: int = 100,
+    method: str = "block",
+    block_length: int = 12,
+    alpha: float = 0.05,
+    seed: int = 0,
+    max_workers: Optional[int] = None,
+) -> xarray.Dataset:
+    """Test the lag regressions of a field on an index for significance.
+
+    The lag convention matches soi_olr_lag_regression.org, where a positive
+    lag regresses the field on the index that many time steps earlier.
+
+    Args:
+        index (pd.Series): the monthly index, aligned to the field by month.
+        data_array (xarray.DataArray): the field, with a time dimension.
+        max_lag (int): the largest lag in time steps, in both directions.
+        n_surrogates (int): the total number of surrogates.
+        batch_size (int): the number of surrogates evaluated together.
+        method (str): "block" for a moving block bootstrap or "phase" for
+            phase randomization.
+        block_length (int): the block length of the bootstrap.
+        alpha (float): the false discovery rate for field significance.
+        seed (int): the seed of the random number generator.
+        max_workers (int): the number of processes to use, or None to use
+            every core.
+
+    Returns:
+        xarray.Dataset: the regression slope, the p-value and the FDR
+            significance of each cell at each lag, and whether the field is
+            significant at each lag.
+    """
+    data_array = data_array.transpose("time", ...)
+    grid_dims = data_array.dims[1:]
+    grid_shape = data_array.shape[1:]
+
+    # Align the index to the field and drop months without an index value
+    x = indices.align_to_time(index, data_array["time"]).to_numpy(dtype=np.float64)
+    keep = np.isfinite(x)
+    x = x[keep]
+    field = np.asarray(data_array.values, dtype=np.float64)[keep].reshape(x.size, -1)
+
+    # Cells with missing values are not tested
+    tested = np.isfinite(field).all(axis=0)
+    field = field[:, tested]
+
+    # The observed slopes
+    observed = np.stack([slopes[0] for slopes in _regression_slopes(x[None, :], field, max_lag)])
+
+    # Evaluate the surrogates in batches across the process pool
+    batch_sizes = [batch_size] * (n_surrogates // batch_size)
+    if n_surrogates % batch_size:
+        batch_sizes.append(n_surrogates % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    exceedances = np.zeros(observed.shape, dtype=np.int64)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(x, field, observed, max_lag, method, block_length),
+    ) as executor:
+        for counts in executor.map(_run_batch, seeds, batch_sizes):
+            exceedances += counts
+    p_tested = (exceedances + 1) / (n_surrogates + 1)
+
+    # Put the tested cells back on the grid
+    n_lags = 2 * max_lag + 1
+    slopes = np.full((n_lags, tested.size), np.nan)
+    p_values = np.full((n_lags, tested.size), np.nan)
+    slopes[:, tested] = observed
+    p_values[:, tested] = p_tested
+    significant = np.stack([false_discovery_rate(p, alpha) for p in p_values])
+
+    dims = ("lag_months",) + grid_dims
+    shape = (n_lags,) + grid_shape
+    coords = {dim: data_array[dim] for dim in grid_dims if dim in data_array.coords}
+    coords["lag_months"] = np.arange(-max_lag, max_lag + 1)
+
+    return xarray.Dataset(
+        {
+            "slope": (dims, slopes.reshape(shape)),
+            "p_value": (dims, p_values.reshape(shape)),
+            "significant": (dims, significant.reshape(shape)),
+            "field_significant": ("lag_months", significant.any(axis=1)),
+        },
+        coords=coords,
+        attrs={"method": method, "n_surrogates": n_surrogates, "alpha": alpha},
+    )
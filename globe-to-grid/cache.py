@@ -0,0 +1,350 @@
+"""Shared in-memory cache of opened datasets, shapefiles and tables.
+
+Entries are keyed by the absolute file path together with the file's
+modification time and size, and those of a shapefile's sidecar files, so a
+file that is re-downloaded or rewritten is never served from a stale entry.
+The least recently used entries are evicted once either the entry or byte
+limit is exceeded. Dropped objects are not closed, since callers may still
+hold copies that share their open files; each is closed by garbage
+collection once the last copy is gone.
+"""
+
+# Import modules
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+def estimate_nbytes(obj: Any) -> int:
+    """Estimate the in-memory size of a cached object.
+
+    Args:
+        obj: an xarray object, a (Geo)DataFrame or any other Python object.
+
+    Returns:
+        int: the estimated size of the object in bytes.
+    """
+    # Pandas and GeoPandas objects report their own memory usage
+    if hasattr(obj, "memory_usage"):
+        try:
+            usage = obj.memory_usage(deep=True)
+            return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+        except TypeError:
+            pass
+
+    # xarray and numpy objects report their nominal size
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+
+    return sys.getsizeof(obj)
+
+
+def file_signature(path: str) -> Tuple[str, int, int]:
+    """Identify the current version of a file on disk.
+
+    Args:
+        path (str): the path to the file.
+
+    Returns:
+        tuple: the absolute path, modification time in nanoseconds and size
+            in bytes of the file.
+    """
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+
+    return abs_path, stat.st_mtime_ns, stat.st_size
+
+
+# Files read alongside a shapefile, which can be rewritten on their own
+SHAPEFILE_SIDECARS = (".dbf", ".shx", ".prj", ".cpg")
+
+
+def version_signature(path: str) -> Tuple:
+    """Identify the current version of a file and the files read with it.
+
+    For a shapefile, the modification times and sizes of its .dbf, .shx,
+    .prj and .cpg files are included, so that rewriting any of them is seen
+    as a new version.
+
+    Args:
+        path (str): the path to the file.
+
+    Returns:
+        tuple: the file signature, followed by a tuple of the signatures of
+            any sidecar files that exist.
+    """
+    signature = file_signature(path)
+    root, ext = os.path.splitext(signature[0])
+    sidecars = ()
+    if ext.lower() == ".shp":
+        sidecars = tuple(
+            file_signature(root + sidecar)
+            for sidecar in SHAPEFILE_SIDECARS
+            if os.path.exists(root + sidecar)
+        )
+
+    return signature + (sidecars,)
+
+
+def freeze(value: Any) -> Hashable:
+    """Convert a value to a hashable form for use in a cache key.
+
+    Args:
+        value: the value, which may contain dicts, lists and sets.
+
+    Returns:
+        the value with dicts, lists and sets converted to tuples.
+    """
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted((key, freeze(item)) for key, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__, tuple(freeze(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return ("set", tuple(sorted(freeze(item) for item in value)))
+    hash(value)
+
+    return value
+
+
+class FileCache:
+    """Thread-safe LRU cache of objects loaded from files."""
+
+    def __init__(self, max_entries: int = 32, max_bytes: Optional[int] = None):
+        """Initialize the file cache.
+
+        Args:
+            max_entries (int): the maximum number of objects to keep.
+            max_bytes (int): the maximum estimated size of all cached objects,
+                or None to only limit the number of entries.
+        """
+        # Set the cache limits
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Cached objects, ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._nbytes = 0
+
+        # One lock guards the entries, and one lock per key stops the same
+        # file from being parsed twice by concurrent callers
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+        # Keep track of hits and misses
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self,
+        path: str,
+        loader: Callable[..., Any],
+        options: Tuple[Hashable, ...] = (),
+        **kwargs,
+    ) -> Any:
+        """Return the object loaded from a file, loading it on a cache miss.
+
+        Args:
+            path (str): the path to the file to load.
+            loader (callable): the function used to load the file, called as
+                loader(path, **kwargs).
+            options (tuple): any extra hashable values that distinguish
+                differently prepared objects read from the same file.
+            **kwargs: keyword arguments passed on to the loader.
+
+        Returns:
+            the cached object. Objects with a copy method are returned as a
+                shallow copy so that callers may add or replace variables and
+                columns without changing the cached object.
+        """
+        # Build the cache key from the file version and load options, and
+        # load without caching if the options can't be used in a key
+        signature = version_signature(path)
+        try:
+            key = (
+                signature,
+                getattr(loader, "__module__", None),
+                getattr(loader, "__qualname__", repr(loader)),
+                freeze(options),
+                freeze(kwargs),
+            )
+        except TypeError:
+            return loader(signature[0], **kwargs)
+
+        # Return the cached object if there is one
+        obj = self._lookup(key)
+        if obj is not None:
+            return _shallow_copy(obj)
+
+        # Only let one caller load a given key at a time
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        try:
+            with load_lock:
+                obj = self._lookup(key, count=False)
+                if obj is None:
+                    obj = loader(signature[0], **kwargs)
+                    self._insert(key, obj)
+        finally:
+            with self._lock:
+                self._load_locks.pop(key, None)
+
+        return _shallow_copy(obj)
+
+    def invalidate(self, path: str):
+        """Drop every cached object that was loaded from a file.
+
+        Args:
+            path (str): the path to the file.
+        """
+        abs_path = os.path.abspath(path)
+        with self._lock:
+            for key in list(self._entries):
+                if key[0][0] == abs_path:
+                    self._remove(key)
+
+    def clear(self):
+        """Drop every cached object."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def configure(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        """Change the cache limits, evicting entries if needed.
+
+        Args:
+            max_entries (int): the new maximum number of objects, if given.
+            max_bytes (int): the new maximum estimated size in bytes, if given.
+        """
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def nbytes(self) -> int:
+        """int: the estimated size of all cached objects in bytes."""
+        return self._nbytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key, count: bool = True):
+        """Find a cached object and mark it as most recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def _insert(self, key, obj):
+        """Add a loaded object, replacing older versions of the same file."""
+        nbytes = estimate_nbytes(obj)
+        with self._lock:
+            # Older versions of the file can never be hit again
+            abs_path = key[0][0]
+            stale = [k for k in self._entries if k[0][0] == abs_path and k[0] != key[0]]
+            for stale_key in stale:
+                self._remove(stale_key)
+
+            self._entries[key] = (obj, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def _remove(self, key):
+        """Remove an entry. The caller must hold the lock."""
+        _, nbytes = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    def _evict(self):
+        """Evict least recently used entries. The caller must hold the lock."""
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None
+            and self._nbytes > self.max_bytes
+            and len(self._entries) > 1
+        ):
+            self._remove(next(iter(self._entries)))
+
+
+def _shallow_copy(obj: Any) -> Any:
+    """Copy an object's container without copying its data."""
+    try:
+        return obj.copy(deep=False)
+    except (AttributeError, TypeError):
+        return obj
+
+
+# The cache shared by all modules in the process
+default_cache = FileCache()
+
+
+def configure(max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+    """Change the limits of the shared cache.
+
+    Args:
+        max_entries (int): the new maximum number of objects, if given.
+        max_bytes (int): the new maximum estimated size in bytes, if given.
+    """
+    default_cache.configure(max_entries=max_entries, max_bytes=max_bytes)
+
+
+def open_dataset(path: str, **kwargs):
+    """Open a netCDF file with xarray through the shared cache.
+
+    Args:
+        path (str): the path to the netCDF file.
+        **kwargs: keyword arguments passed on to xarray.open_dataset.
+
+    Returns:
+        xarray.Dataset: the opened dataset.
+    """
+    import xarray
+
+    return default_cache.get(path, xarray.open_dataset, **kwargs)
+
+
+def read_file(path: str, **kwargs):
+    """Read a shapefile with geopandas through the shared cache.
+
+    Args:
+        path (str): the path to the shapefile.
+        **kwargs: keyword arguments passed on to geopandas.read_file.
+
+    Returns:
+        geopandas.GeoDataFrame: the shapefile contents.
+    """
+    import geopandas as gpd
+
+    return default_cache.get(path, gpd.read_file, **kwargs)
+
+
+def read_csv(path: str, **kwargs):
+    """Read a CSV file with pandas through the shared cache.
+
+    Args:
+        path (str): the path to the CSV file.
+        **kwargs: keyword arguments passed on to pandas.read_csv.
+
+    Returns:
+        pandas.DataFrame: the table contents.
+    """
+    import pandas as pd
+
+    return default_cache.get(path, pd.read_csv, **kwargs)
+
+
+def invalidate(path: str):
+    """Drop every object loaded from a file from the shared cache.
+
+    Args:
+        path (str): the path to the file.
+    """
+    default_cache.invalidate(path)
@@ -0,0 +1,108 @@
+"""Lightweight command line entry point for downloads and grid lookups.
+
+Only the standard library, numpy and the light grid and variables modules
+are imported at startup. Everything else is imported by the command that
+needs it, so short lived cron and shell invocations start quickly.
+
+Examples:
+    python cli.py download ncep --data-dir ./data/meteorological
+    python cli.py download olr --data-dir ./data/ --years 2017 2021
+    python cli.py lookup point 13.4 52.5 --gridspacing 2.5
+    python cli.py lookup city Berlin Germany
+"""
+
+# Import modules
+import argparse
+import importlib.util
+import os
+from typing import List, Optional
+import grid
+import variables
+
+# The OLR module lives with the other variable downloads
+OLR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../variables/olr/olr.py")
+
+
+def download_ncep(data_dir: str, var_list: Optional[List[str]] = None) -> dict:
+    """Download NCEP monthly mean surface variables.
+
+    Args:
+        data_dir (str): the directory to download the data to.
+        var_list (list): the variables to download, or None for all of them.
+
+    Returns:
+        dict: the downloaded file path of each variable.
+    """
+    var_download = variables.download(data_dir)
+    var_list = var_list or var_download.varList
+
+    return {var: var_download.download_surface_variable(var) for var in var_list}
+
+
+def download_olr(data_dir: str, years: Optional[List[int]] = None):
+    """Download the monthly OLR file and, optionally, yearly daily files.
+
+    Args:
+        data_dir (str): the directory to download the data to.
+        years (list): the first and last year of daily files to download,
+            or None to only download the monthly file.
+    """
+    # Load the module from its file rather than changing sys.path
+    spec = importlib.util.spec_from_file_location("olr", OLR_PATH)
+    olr = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(olr)
+
+    olr.download_monthly_file(data_dir)
+    if years:
+        begin_year, end_year = years[0], years[-1]
+        olr.download_daily_files(data_dir, list(range(begin_year, end_year + 1)))
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run a download or lookup command.
+
+    Args:
+        argv (list): the command line arguments, or None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # Download commands
+    download_parser = commands.add_parser("download", help="download data files")
+    download_parser.add_argument("source", choices=["ncep", "olr"])
+    download_parser.add_argument("--data-dir", default="./data/")
+    download_parser.add_argument("--vars", nargs="+", help="NCEP variables to download")
+    download_parser.add_argument("--years", nargs=2, type=int, help="first and last year of daily OLR")
+
+    # Lookup commands
+    lookup_parser = commands.add_parser("lookup", help="look up grid ids")
+    lookups = lookup_parser.add_subparsers(dest="kind", required=True)
+    point_parser = lookups.add_parser("point", help="grid id containing a point")
+    point_parser.add_argument("lon", type=float)
+    point_parser.add_argument("lat", type=float)
+    point_parser.add_argument("--gridspacing", type=float, default=2.5)
+    country_parser = lookups.add_parser("country", help="grid ids overlapping a country")
+    country_parser.add_argument("country")
+    country_parser.add_argument("--shp-dir", default="./data/shapefiles/")
+    city_parser = lookups.add_parser("city", help="grid ids overlapping a city")
+    city_parser.add_argument("city")
+    city_parser.add_argument("country")
+    city_parser.add_argument("--shp-dir", default="./data/shapefiles/")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "download" and args.source == "ncep":
+        for var, file_path in download_ncep(args.data_dir, args.vars).items():
+            print(f"{var}: {file_path}")
+    elif args.command == "download":
+        download_olr(args.data_dir, args.years)
+    elif args.kind == "point":
+        print(grid.find_point_grid_id(args.lon, args.lat, args.gridspacing))
+    elif args.kind == "country":
+        print(*grid.find_country_name_grids(args.country, args.shp_dir))
+    else:
+        print(*grid.find_city_name_grids(args.city, args.country, args.shp_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
-import geopandas as gpd
-import pandas as pd
+# Geopandas, pandas and shapely are imported where they are used, so that
+# lookups that only need the grid arithmetic or the spatial join CSVs start
+# quickly
+import math
 import numpy as np
-from shapely.geometry import Point, Polygon
+import cache
 
 def read_cities_shp(shpdir="./data/shapefiles/"):
 
@@ -10,7 +12,7 @@ def read_cities_shp(shpdir="./data/shapefiles/"):
     """
 
     # Read the cities shapefile
-    gdfCities = gpd.read_file(shpdir+"World_Cities.shp")
+    gdfCities = cache.read_file(shpdir+"World_Cities.shp")
 
     # Limit the columns to what we need
     keepColumns = ["CITY_NAME","CNTRY_NAME","geometry"]
@@ -25,7 +27,7 @@ def read_countries_shp(shpdir="./data/shapefiles/"):
     """
 
     # Read the countries shapefile
-    gdfCountries = gpd.read_file(shpdir+"World_Countries__Generalized_.shp")
+    gdfCountries = cache.read_file(shpdir+"World_Countries__Generalized_.shp")
 
     # Limit the columns to what we need
     keepColumns = ["COUNTRY","geometry"]
@@ -53,6 +55,9 @@ def construct_grid(shpdir="./data/shapefiles/",gridspacing=2.5):
     results to a shapefile
     """
 
+    import geopandas as gpd
+    from shapely.geometry import Polygon
+
     # Construct the lat/lon arrays
     longitude, latitude = construct_grid_arrays(gridspacing)
 
@@ -68,6 +73,7 @@ def construct_grid(shpdir="./data/shapefiles/",gridspacing=2.5):
     # Create the grid geodataframe and send to shapefile
     gdfGrid = gpd.GeoDataFrame({'geometry':polygonList})
     gdfGrid.to_file(shpdir+"grid_"+str(gridspacing)+".shp")
+    cache.invalidate(shpdir+"grid_"+str(gridspacing)+".shp")
 
     return gdfGrid
 
@@ -77,6 +83,9 @@ def grid_country_sjoin(idDir="./data/ids/"):
     Use a spatial join to find indices for overlapping grids and countries.
     """
 
+    import geopandas as gpd
+    import pandas as pd
+
     # Perform spatial join
     gdfIntersectsCountries = gpd.sjoin(gdfGrid,gdfCountries,how="left")
 
@@ -88,6 +97,7 @@ def grid_country_sjoin(idDir="./data/ids/"):
 
     # Send output to CSV
     dfIntersectsCountries.to_csv(idDir+'grid_country_sjoin.csv',index_label="grid_id")
+    cache.invalidate(idDir+'grid_country_sjoin.csv')
 
     return dfIntersectsCountries
 
@@ -97,6 +107,9 @@ def grid_city_sjoin(idDir="./data/ids/"):
     Use a spatial join to find indices for overlapping grids and cities.
     """
 
+    import geopandas as gpd
+    import pandas as pd
+
     # Perform spatial join
     gdfIntersectsCities = gpd.sjoin(gdfGrid,gdfCities,how="left")
 
@@ -108,6 +121,7 @@ def grid_city_sjoin(idDir="./data/ids/"):
 
     # Send output to CSV
     dfIntersectsCities.to_csv(idDir+'grid_city_sjoin.csv',index_label="grid_id")
+    cache.invalidate(idDir+'grid_city_sjoin.csv')
 
     return dfIntersectsCities
 
@@ -118,7 +132,7 @@ def find_country_id_grids(countryId,idPath="./data/ids/grid_country_sjoin.csv"):
     """
 
     # Read the spatial join CSV
-    df = pd.read_csv(idPath)
+    df = cache.read_csv(idPath)
 
     # Find the grid IDs for a given country
     gridList = df.loc[df["country_id"]==countryId]['grid_id'].to_list()
@@ -132,7 +146,7 @@ def find_city_id_grids(cityId,idPath="./data/ids/grid_city_sjoin.csv"):
     """
 
     # Read the spatial join CSV
-    df = pd.read_csv(idPath)
+    df = cache.read_csv(idPath)
 
     # Find the grid IDs for a given country
     gridList = df.loc[df["city_id"]==cityId]['grid_id'].to_list()
@@ -180,9 +194,12 @@ def find_point_grids(lon,lat,shpdir="./data/shapefiles/",gridspacing=2.5):
     Look up which grid cell contains a specified latitude and longitude.
     """
 
+    import geopandas as gpd
+    from shapely.geometry import Point
+
     # Read the grid shapefile
     gridPath = shpdir+"grid_"+str(gridspacing)+".shp"
-    gdfGrid = gpd.read_file(gridPath)
+    gdfGrid = cache.read_file(gridPath)
 
     # Create point geometry
     point = Point(lon,lat)
@@ -195,3 +212,24 @@ def find_point_grids(lon,lat,shpdir="./data/shapefiles/",gridspacing=2.5):
     gridId = gdfIntersection["index_left"].to_list()[0]
 
     return gridId
+
+def find_point_grid_id(lon,lat,gridspacing=2.5):
+
+    """
+    Calculate which grid cell contains a specified latitude and longitude
+    without reading the grid shapefile. Grid cells are numbered the same way
+    as in construct_grid, so this matches the ID from find_point_grids.
+    """
+
+    # Count the grid cells in each direction
+    nLon = int(round(360/gridspacing))
+    nLat = int(round(180/gridspacing))
+
+    # Find the row and column of the grid cell containing the point
+    iLon = min(int(math.floor(((lon+180) % 360)/gridspacing)),nLon-1)
+    iLat = min(max(int(math.floor((lat+90)/gridspacing)),0),nLat-1)
+
+    # Grid cells are numbered by latitude, then longitude
+    gridId = iLat*nLon + iLon
+
+    return gridId
@@ -0,0 +1,84 @@
+"""Check the import time of the lightweight modules against a budget.
+
+Each module is imported in a fresh interpreter several times, and the best
+time less the time of an interpreter that imports nothing is compared with
+the module's budget. The script exits with an error if any module is over
+budget, so it can be run alongside the other benchmarks.
+
+Example:
+    python import_time.py
+"""
+
+# Import modules
+import os
+import subprocess
+import sys
+import time
+from typing import Dict
+
+# Import time budgets in seconds
+IMPORT_BUDGETS = {
+    "cache": 0.05,
+    "grid": 0.2,
+    "variables": 0.1,
+    "olr": 0.1,
+    "cli": 0.3,
+}
+
+# Directories holding the modules, added to the path of each interpreter
+MODULE_DIRS = [
+    os.path.dirname(os.path.abspath(__file__)),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../variables/olr"),
+]
+
+
+def time_import(module: str, repeat: int = 5) -> float:
+    """Measure the best time to start an interpreter and import a module.
+
+    Args:
+        module (str): the name of the module to import, or an empty string
+            to only start the interpreter.
+        repeat (int): the number of interpreters to time.
+
+    Returns:
+        float: the fastest time in seconds.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(MODULE_DIRS))
+    statement = f"import {module}" if module else "pass"
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], env=env, check=True)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def check_import_budgets(budgets: Dict[str, float] = IMPORT_BUDGETS, repeat: int = 5) -> Dict[str, float]:
+    """Measure the import time of each module and compare it with its budget.
+
+    Args:
+        budgets (dict): the budget in seconds of each module.
+        repeat (int): the number of interpreters to time for each module.
+
+    Returns:
+        dict: the measured import time of each module in seconds.
+    """
+    baseline = time_import("", repeat)
+
+    return {module: max(time_import(module, repeat) - baseline, 0.0) for module in budgets}
+
+
+if __name__ == "__main__":
+
+    # Report each module's import time and fail if any is over budget
+    import_times = check_import_budgets()
+    over_budget = False
+    for module, import_time in import_times.items():
+        budget = IMPORT_BUDGETS[module]
+        status = "ok" if import_time <= budget else "OVER BUDGET"
+        over_budget = over_budget or import_time > budget
+        print(f"{module:<12} {import_time * 1000:7.1f} ms  (budget {budget * 1000:.0f} ms)  {status}")
+
+    sys.exit(1 if over_budget else 0)
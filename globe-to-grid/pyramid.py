@@ -0,0 +1,315 @@
+"""Multi-resolution pyramid of area weighted grid aggregates.
+
+The source dataset is regridded onto the finest level of the pyramid with
+the conservative regridder, and every coarser level is aggregated from that
+base level by area weighted block means. Both are done a chunk of time steps
+at a time, with each chunk appended to the level files, so memory use is
+bounded by the chunk size rather than the length of the record. Each level uses the tiles of
+grid.construct_grid at its own spacing, so its cell ids match the grid ids
+returned by grid.find_point_grids for that spacing.
+
+Queries pick the coarsest level that still resolves the requested output
+size over the requested bounding box, so map renders and region summaries
+read as few cells as possible.
+"""
+
+# Import modules
+import os
+from typing import Dict, Optional, Sequence, Tuple
+import numpy as np
+import xarray
+import cache
+import grid
+import regrid
+
+# Grid spacings of the pyramid levels, in degrees
+DEFAULT_LEVELS = (0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Engine used to write the level files, which supports appending in time
+LEVEL_ENGINE = "h5netcdf"
+
+
+def point_cell_id(lon: float, lat: float, gridspacing: float = 2.5) -> int:
+    """Find the id of the grid tile containing a point.
+
+    Tiles are numbered like grid.construct_grid, which loops over latitude
+    from -90 and then longitude from -180, so this matches the grid id that
+    grid.find_point_grids finds from the grid shapefile.
+
+    Args:
+        lon (float): the longitude of the point, from -180 to 180.
+        lat (float): the latitude of the point.
+        gridspacing (float): the spacing of the grid in degrees.
+
+    Returns:
+        int: the grid id of the tile containing the point.
+    """
+    return grid.find_point_grid_id(lon, lat, gridspacing)
+
+
+def cell_ids(gridspacing: float = 2.5) -> np.ndarray:
+    """Number every tile of a grid like grid.construct_grid.
+
+    Args:
+        gridspacing (float): the spacing of the grid in degrees.
+
+    Returns:
+        np.ndarray: a (lat, lon) array of grid ids.
+    """
+    n_lon = int(round(360 / gridspacing))
+    n_lat = int(round(180 / gridspacing))
+
+    return np.arange(n_lat * n_lon).reshape(n_lat, n_lon)
+
+
+def coarsen(data_array: xarray.DataArray, factor: int) -> xarray.DataArray:
+    """Aggregate a lat/lon field by area weighted means over square blocks.
+
+    Missing values are left out, so each coarse cell is the mean over the
+    valid area of the fine cells it contains.
+
+    Args:
+        data_array (xarray.DataArray): the field on a regular grid whose
+            latitude and longitude sizes are multiples of the factor.
+        factor (int): the number of fine cells along each side of a block.
+
+    Returns:
+        xarray.DataArray: the coarsened field.
+    """
+    data_array = data_array.transpose(..., "lat", "lon")
+    other_shape = data_array.shape[:-2]
+    n_lat, n_lon = data_array.shape[-2:]
+
+    # Area weights of each latitude row, from the sine of the cell edges
+    edges = np.sin(np.deg2rad(regrid.cell_edges(data_array["lat"].values, -90, 90)))
+    area = np.diff(edges, axis=1)[:, 0]
+
+    # Weighted block sums of the valid values
+    values = np.asarray(data_array.values, dtype=np.float64)
+    valid = np.isfinite(values)
+    weights = np.where(valid, area[:, None], 0.0)
+    block_shape = other_shape + (n_lat // factor, factor, n_lon // factor, factor)
+    sums = (np.where(valid, values, 0.0) * weights).reshape(block_shape).sum(axis=(-3, -1))
+    total = weights.reshape(block_shape).sum(axis=(-3, -1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(total > 0, sums / total, np.nan)
+
+    lat = data_array["lat"].values.reshape(-1, factor).mean(axis=1)
+    lon = data_array["lon"].values.reshape(-1, factor).mean(axis=1)
+    coords = {dim: data_array[dim] for dim in data_array.dims[:-2] if dim in data_array.coords}
+    coords.update(lat=lat, lon=lon)
+
+    return xarray.DataArray(
+        means.astype(data_array.dtype) if data_array.dtype.kind == "f" else means,
+        dims=data_array.dims,
+        coords=coords,
+        attrs=data_array.attrs,
+    )
+
+
+def append_time_steps(path: str, dataset: xarray.Dataset):
+    """Append time steps to a netCDF file with an unlimited time dimension.
+
+    Args:
+        path (str): the path to a file written by xarray with time as an
+            unlimited dimension.
+        dataset (xarray.Dataset): the time steps to append, with the same
+            variables as the file.
+    """
+    import h5netcdf
+    from xarray.coding.times import encode_cf_datetime
+
+    with h5netcdf.File(path, "a") as nc:
+        start = nc.dimensions["time"].size
+        stop = start + dataset.sizes["time"]
+        nc.resize_dimension("time", stop)
+
+        # Encode the times with the units already in the file
+        time = nc.variables["time"]
+        times, _, _ = encode_cf_datetime(
+            dataset["time"].values,
+            units=time.attrs["units"],
+            calendar=time.attrs.get("calendar"),
+        )
+        time[start:stop] = times
+
+        for name, data_array in dataset.data_vars.items():
+            if "time" in data_array.dims:
+                variable = nc.variables[name]
+                values = data_array.transpose(*variable.dimensions).values
+                variable[start:stop] = values
+
+
+class GridPyramid:
+    """Class for building and querying a pyramid of grid aggregates."""
+
+    def __init__(self, pyramid_dir: str = "./data/pyramid/", levels: Sequence[float] = DEFAULT_LEVELS):
+        """Initialize the grid pyramid.
+
+        Args:
+            pyramid_dir (str): the directory holding a file for each level.
+            levels (sequence): the grid spacings of the levels in degrees.
+                Every spacing must be a whole multiple of the finest one.
+        """
+        # Set the class properties
+        self.pyramid_dir = pyramid_dir
+        self.levels = tuple(sorted(levels))
+
+        # Check that every level can be aggregated from the finest level
+        finest = self.levels[0]
+        for spacing in self.levels:
+            factor = spacing / finest
+            if abs(factor - round(factor)) > 1e-9 or (180 / spacing) % 1 > 1e-9:
+                raise ValueError(f"Grid spacing {spacing} is not a whole multiple of {finest} dividing 180.")
+
+    def level_path(self, gridspacing: float) -> str:
+        """Build the path to the file of a pyramid level.
+
+        Args:
+            gridspacing (float): the spacing of the level in degrees.
+
+        Returns:
+            str: the path to the level's netCDF file.
+        """
+        return os.path.join(self.pyramid_dir, f"pyramid_{gridspacing}.nc")
+
+    def build(
+        self,
+        dataset: xarray.Dataset,
+        weights_dir: Optional[str] = "./data/weights/",
+        chunk_size: int = 12,
+    ) -> Dict[float, str]:
+        """Build every level of the pyramid from a source dataset.
+
+        The source is regridded onto the finest level and the coarser levels
+        are aggregated from it one chunk of time steps at a time. Each level
+        is written to a temporary file and moved into place once complete,
+        so readers never see a partly written level.
+
+        Args:
+            dataset (xarray.Dataset): the source dataset on any lat/lon grid.
+            weights_dir (str): the directory caching the regridding weights.
+            chunk_size (int): the number of time steps regridded at once.
+
+        Returns:
+            dict: the path to the file of each level, keyed by grid spacing.
+        """
+        os.makedirs(self.pyramid_dir, exist_ok=True)
+        finest = self.levels[0]
+        regridder = regrid.Regridder.to_gridspacing(dataset, finest, weights_dir=weights_dir)
+        paths = {spacing: self.level_path(spacing) for spacing in self.levels}
+        temp_paths = {spacing: f"{path}.tmp" for spacing, path in paths.items()}
+
+        # Datasets without a time dimension are built in a single chunk
+        has_time = "time" in dataset.dims
+        n_times = dataset.sizes["time"] if has_time else 1
+        for start in range(0, n_times, chunk_size):
+            chunk = dataset.isel(time=slice(start, start + chunk_size)) if has_time else dataset
+
+            # Regrid the chunk onto the finest level
+            base = regridder(chunk)
+
+            # Aggregate each level from the finest level and write it out
+            for spacing in self.levels:
+                factor = int(round(spacing / finest))
+                if factor == 1:
+                    level = base.copy()
+                else:
+                    level = xarray.Dataset(
+                        {name: coarsen(base[name], factor) for name in base.data_vars},
+                        attrs=base.attrs,
+                    )
+
+                if start == 0:
+                    level["cell_id"] = (("lat", "lon"), cell_ids(spacing))
+                    level.attrs["gridspacing"] = spacing
+                    level.to_netcdf(
+                        temp_paths[spacing],
+                        engine=LEVEL_ENGINE,
+                        unlimited_dims=["time"] if has_time else None,
+                    )
+                else:
+                    append_time_steps(temp_paths[spacing], level)
+
+        # Drop cached copies of the old levels, then move the new ones in
+        for spacing, path in paths.items():
+            cache.invalidate(path)
+            os.replace(temp_paths[spacing], path)
+
+        return paths
+
+    def open_level(self, gridspacing: float) -> xarray.Dataset:
+        """Open a pyramid level, reusing it if it is already open.
+
+        Args:
+            gridspacing (float): the spacing of the level in degrees.
+
+        Returns:
+            xarray.Dataset: the level's dataset.
+        """
+        return cache.open_dataset(self.level_path(gridspacing))
+
+    def select_level(self, bbox: Tuple[float, float, float, float], output_size: Tuple[int, int]) -> float:
+        """Pick the coarsest level that resolves an output size over a box.
+
+        Args:
+            bbox (tuple): the bounding box as (lon_min, lat_min, lon_max,
+                lat_max), with longitudes from -180 to 180.
+            output_size (tuple): the output size as (width, height) in pixels
+                or cells.
+
+        Returns:
+            float: the grid spacing of the selected level.
+        """
+        lon_min, lat_min, lon_max, lat_max = bbox
+        width, height = output_size
+
+        # The coarsest spacing that still gives a cell per output pixel
+        needed = min((lon_max - lon_min) / max(width, 1), (lat_max - lat_min) / max(height, 1))
+        adequate = [spacing for spacing in self.levels if spacing <= needed]
+
+        return adequate[-1] if adequate else self.levels[0]
+
+    def query(self, bbox: Tuple[float, float, float, float], output_size: Tuple[int, int]) -> xarray.Dataset:
+        """Read the cells within a box from the coarsest adequate level.
+
+        Args:
+            bbox (tuple): the bounding box as (lon_min, lat_min, lon_max,
+                lat_max), with longitudes from -180 to 180.
+            output_size (tuple): the output size as (width, height).
+
+        Returns:
+            xarray.Dataset: the level's cells whose centers are in the box.
+        """
+        lon_min, lat_min, lon_max, lat_max = bbox
+        level = self.open_level(self.select_level(bbox, output_size))
+
+        return level.sel(lon=slice(lon_min, lon_max), lat=slice(lat_min, lat_max))
+
+    def region_mean(self, bbox: Tuple[float, float, float, float], var_name: str) -> xarray.DataArray:
+        """Average a variable over a box using as few cells as possible.
+
+        The coarsest level whose cell edges line up with the box is used, so
+        the area weighted mean is the same as at the finest level.
+
+        Args:
+            bbox (tuple): the bounding box as (lon_min, lat_min, lon_max,
+                lat_max), with longitudes from -180 to 180.
+            var_name (str): the name of the variable to average.
+
+        Returns:
+            xarray.DataArray: the area weighted mean of the variable.
+        """
+        # Find the coarsest level whose edges fall on the box
+        def aligned(spacing):
+            return all(abs(edge / spacing - round(edge / spacing)) < 1e-9 for edge in bbox)
+
+        spacing = max([spacing for spacing in self.levels if aligned(spacing)], default=self.levels[0])
+        lon_min, lat_min, lon_max, lat_max = bbox
+        level = self.open_level(spacing)
+        region = level[var_name].sel(lon=slice(lon_min, lon_max), lat=slice(lat_min, lat_max))
+
+        # Weight by the area of each cell
+        weights = np.cos(np.deg2rad(region["lat"]))
+
+        return region.weighted(weights.fillna(0)).mean(dim=["lat", "lon"])
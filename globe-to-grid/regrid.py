@@ -0,0 +1,314 @@
+"""First-order conservative regridding between latitude-longitude grids.
+
+The weights are the fraction of each target cell's area that is covered by
+each source cell. On a sphere the area of a latitude-longitude cell is
+proportional to the longitude width times the difference in the sine of the
+bounding latitudes, so the weight matrix is the Kronecker product of a
+latitude overlap matrix and a longitude overlap matrix. Longitudes are
+treated as periodic, so grids on 0 to 360 and -180 to 180 can be mixed.
+"""
+
+# Import modules
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Optional, Tuple
+import numpy as np
+import scipy.sparse
+import xarray
+
+
+def cell_edges(centers: np.ndarray, lower: Optional[float] = None, upper: Optional[float] = None) -> np.ndarray:
+    """Find the bounds of each grid cell from the cell centers.
+
+    Interior edges lie halfway between neighbouring centers, and the outer
+    edges lie half a cell beyond the first and last centers.
+
+    Args:
+        centers (np.ndarray): the 1D array of cell centers, in ascending or
+            descending order.
+        lower (float): the smallest allowed edge, if any.
+        upper (float): the largest allowed edge, if any.
+
+    Returns:
+        np.ndarray: an (n, 2) array holding the lower and upper edge of each
+            cell, in the same order as the centers.
+    """
+    centers = np.asarray(centers, dtype=np.float64)
+    if centers.size < 2:
+        raise ValueError("At least two cell centers are needed to find cell edges.")
+
+    # Midpoints between centers, extended by half a cell at each end
+    midpoints = 0.5 * (centers[1:] + centers[:-1])
+    first = centers[0] - (midpoints[0] - centers[0])
+    last = centers[-1] + (centers[-1] - midpoints[-1])
+    edges = np.concatenate([[first], midpoints, [last]])
+
+    # Clip to the allowed range, e.g. the poles
+    if lower is not None or upper is not None:
+        edges = np.clip(edges, lower, upper)
+
+    bounds = np.stack([edges[:-1], edges[1:]], axis=1)
+
+    return np.sort(bounds, axis=1)
+
+
+def overlap_matrix(source_bounds: np.ndarray, target_bounds: np.ndarray, period: Optional[float] = None) -> np.ndarray:
+    """Measure the overlap of every pair of source and target intervals.
+
+    Args:
+        source_bounds (np.ndarray): an (n, 2) array of source intervals.
+        target_bounds (np.ndarray): an (m, 2) array of target intervals.
+        period (float): the period of the coordinate, e.g. 360 for
+            longitude, or None if the coordinate is not periodic.
+
+    Returns:
+        np.ndarray: an (m, n) array of overlap lengths.
+    """
+    shifts = [0.0] if period is None else [-period, 0.0, period]
+
+    overlap = np.zeros((target_bounds.shape[0], source_bounds.shape[0]))
+    for shift in shifts:
+        lo = np.maximum(target_bounds[:, None, 0], source_bounds[None, :, 0] + shift)
+        hi = np.minimum(target_bounds[:, None, 1], source_bounds[None, :, 1] + shift)
+        overlap += np.clip(hi - lo, 0, None)
+
+    return overlap
+
+
+def conservative_weights(
+    source_lon: np.ndarray,
+    source_lat: np.ndarray,
+    target_lon: np.ndarray,
+    target_lat: np.ndarray,
+) -> scipy.sparse.csr_matrix:
+    """Compute first-order conservative regridding weights.
+
+    Args:
+        source_lon (np.ndarray): the source grid longitude centers.
+        source_lat (np.ndarray): the source grid latitude centers.
+        target_lon (np.ndarray): the target grid longitude centers.
+        target_lat (np.ndarray): the target grid latitude centers.
+
+    Returns:
+        scipy.sparse.csr_matrix: a (target cells, source cells) matrix whose
+            entries are the fraction of each target cell covered by each
+            source cell. Cells are numbered with longitude varying fastest.
+    """
+    # Find the cell bounds, in sine of latitude for the latitude direction
+    source_lat_bounds = np.sin(np.deg2rad(cell_edges(source_lat, -90, 90)))
+    target_lat_bounds = np.sin(np.deg2rad(cell_edges(target_lat, -90, 90)))
+    source_lon_bounds = cell_edges(source_lon)
+    target_lon_bounds = cell_edges(target_lon)
+
+    # Normalize the overlaps by the size of the target cells
+    lat_weights = overlap_matrix(source_lat_bounds, target_lat_bounds)
+    lat_weights /= np.diff(target_lat_bounds, axis=1)
+    lon_weights = overlap_matrix(source_lon_bounds, target_lon_bounds, period=360.0)
+    lon_weights /= np.diff(target_lon_bounds, axis=1)
+
+    # Combine the two directions into the full cell-to-cell matrix
+    weights = scipy.sparse.kron(
+        scipy.sparse.csr_matrix(lat_weights),
+        scipy.sparse.csr_matrix(lon_weights),
+        format="csr",
+    )
+    weights.eliminate_zeros()
+
+    return weights
+
+
+def grid_centers(gridspacing: float = 2.5) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the centers of the tiles built by grid.construct_grid.
+
+    Args:
+        gridspacing (float): the spacing of the grid in degrees.
+
+    Returns:
+        tuple: the longitude and latitude centers of the grid tiles.
+    """
+    import grid
+
+    # The grid arrays hold the lower left corner of each tile
+    longitude, latitude = grid.construct_grid_arrays(gridspacing)
+
+    return longitude + gridspacing / 2, latitude + gridspacing / 2
+
+
+class Regridder:
+    """Class for conservatively regridding datasets between two grids."""
+
+    # Weights already used in this process, keyed by grid pair
+    _memory = {}
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        source_lon: np.ndarray,
+        source_lat: np.ndarray,
+        target_lon: np.ndarray,
+        target_lat: np.ndarray,
+        weights_dir: Optional[str] = "./data/weights/",
+    ):
+        """Initialize the regridder, loading or computing its weights.
+
+        Args:
+            source_lon (np.ndarray): the source grid longitude centers.
+            source_lat (np.ndarray): the source grid latitude centers.
+            target_lon (np.ndarray): the target grid longitude centers.
+            target_lat (np.ndarray): the target grid latitude centers.
+            weights_dir (str): the directory where weights are cached on
+                disk, or None to only cache weights in memory.
+        """
+        # Set the grid properties
+        self.source_lon = np.asarray(source_lon, dtype=np.float64)
+        self.source_lat = np.asarray(source_lat, dtype=np.float64)
+        self.target_lon = np.asarray(target_lon, dtype=np.float64)
+        self.target_lat = np.asarray(target_lat, dtype=np.float64)
+        self.weights_dir = weights_dir
+
+        # Load or compute the weights
+        self.weights = self._load_weights()
+
+    @classmethod
+    def from_datasets(cls, source: xarray.Dataset, target: xarray.Dataset, **kwargs) -> "Regridder":
+        """Build a regridder between the lat/lon grids of two datasets.
+
+        Args:
+            source (xarray.Dataset): a dataset on the source grid.
+            target (xarray.Dataset): a dataset on the target grid.
+            **kwargs: keyword arguments passed on to Regridder.
+
+        Returns:
+            Regridder: the regridder between the two grids.
+        """
+        return cls(source["lon"].values, source["lat"].values, target["lon"].values, target["lat"].values, **kwargs)
+
+    @classmethod
+    def to_gridspacing(cls, source: xarray.Dataset, gridspacing: float = 2.5, **kwargs) -> "Regridder":
+        """Build a regridder onto the tiles of grid.construct_grid.
+
+        Args:
+            source (xarray.Dataset): a dataset on the source grid.
+            gridspacing (float): the spacing of the target grid in degrees.
+            **kwargs: keyword arguments passed on to Regridder.
+
+        Returns:
+            Regridder: the regridder onto the tile grid.
+        """
+        target_lon, target_lat = grid_centers(gridspacing)
+
+        return cls(source["lon"].values, source["lat"].values, target_lon, target_lat, **kwargs)
+
+    @property
+    def key(self) -> str:
+        """str: a hash identifying the source and target grids."""
+        digest = hashlib.sha1()
+        for array in (self.source_lon, self.source_lat, self.target_lon, self.target_lat):
+            digest.update(np.ascontiguousarray(array).tobytes())
+            digest.update(b"|")
+
+        return digest.hexdigest()[:16]
+
+    @property
+    def weights_path(self) -> Optional[str]:
+        """str: the path to the cached weights file, if any."""
+        if self.weights_dir is None:
+            return None
+        shape = f"{self.source_lat.size}x{self.source_lon.size}_{self.target_lat.size}x{self.target_lon.size}"
+
+        return os.path.join(self.weights_dir, f"conservative_{shape}_{self.key}.npz")
+
+    def _load_weights(self) -> scipy.sparse.csr_matrix:
+        """Get the weights from memory, from disk, or by computing them."""
+        key = self.key
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key]
+
+        # Read the weights from disk, or compute them and write them to disk
+        path = self.weights_path
+        if path is not None and os.path.exists(path):
+            weights = scipy.sparse.load_npz(path).tocsr()
+        else:
+            weights = conservative_weights(self.source_lon, self.source_lat, self.target_lon, self.target_lat)
+            if path is not None:
+                # Write to a temporary file first, so that other processes
+                # computing the same weights never read a partial file
+                os.makedirs(self.weights_dir, exist_ok=True)
+                handle, temp_path = tempfile.mkstemp(suffix=".npz", dir=self.weights_dir)
+                with os.fdopen(handle, "wb") as temp_file:
+                    scipy.sparse.save_npz(temp_file, weights)
+                os.replace(temp_path, path)
+
+        with self._lock:
+            self._memory[key] = weights
+
+        return weights
+
+    def regrid(self, dataset: xarray.Dataset, min_coverage: float = 0.5) -> xarray.Dataset:
+        """Regrid every lat/lon variable in a dataset onto the target grid.
+
+        All time steps and variables are regridded together with one sparse
+        matrix product. Missing values are left out of the average, and
+        target cells with too little valid source coverage are set missing.
+
+        Args:
+            dataset (xarray.Dataset): the dataset on the source grid.
+            min_coverage (float): the minimum fraction of a target cell that
+                must be covered by valid source data.
+
+        Returns:
+            xarray.Dataset: the dataset on the target grid.
+        """
+        n_source = self.source_lat.size * self.source_lon.size
+
+        # Flatten every variable to (source cells, columns)
+        var_names = [name for name in dataset.data_vars if {"lat", "lon"} <= set(dataset[name].dims)]
+        blocks, layouts = [], []
+        for name in var_names:
+            data_array = dataset[name].transpose(..., "lat", "lon")
+            other_dims = data_array.dims[:-2]
+            other_shape = data_array.shape[:-2]
+            values = np.asarray(data_array.values, dtype=np.float64).reshape(-1, n_source).T
+            blocks.append(values)
+            layouts.append((name, other_dims, other_shape, values.shape[1]))
+
+        if not blocks:
+            return xarray.Dataset(coords={"lat": self.target_lat, "lon": self.target_lon})
+
+        # Mask missing values, and regrid the data and masks in one product
+        values = np.concatenate(blocks, axis=1)
+        valid = np.isfinite(values)
+        n_columns = values.shape[1]
+        stacked = np.concatenate([np.where(valid, values, 0.0), valid.astype(np.float64)], axis=1)
+        result = self.weights @ stacked
+        sums, coverage = result[:, :n_columns], result[:, n_columns:]
+
+        # Normalize by the valid coverage of each target cell
+        with np.errstate(invalid="ignore", divide="ignore"):
+            regridded = np.where(coverage >= min_coverage, sums / coverage, np.nan)
+
+        # Split the columns back into variables
+        data_vars = {}
+        start = 0
+        for name, other_dims, other_shape, n_var_columns in layouts:
+            block = regridded[:, start:start + n_var_columns].T
+            start += n_var_columns
+            block = block.reshape(other_shape + (self.target_lat.size, self.target_lon.size))
+            data_array = dataset[name]
+            data_vars[name] = xarray.DataArray(
+                block.astype(data_array.dtype) if data_array.dtype.kind == "f" else block,
+                dims=other_dims + ("lat", "lon"),
+                coords={dim: dataset[dim] for dim in other_dims if dim in dataset.coords},
+                attrs=data_array.attrs,
+            )
+
+        regridded_dataset = xarray.Dataset(data_vars, attrs=dataset.attrs)
+        regridded_dataset = regridded_dataset.assign_coords(lat=self.target_lat, lon=self.target_lon)
+
+        return regridded_dataset
+
+    def __call__(self, dataset: xarray.Dataset, **kwargs) -> xarray.Dataset:
+        return self.regrid(dataset, **kwargs)
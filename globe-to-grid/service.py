@@ -0,0 +1,523 @@
+"""Local query service that keeps grids and datasets warm in memory.
+
+The service answers city, country and point queries for time series and
+monthly climatologies of the NCEP surface variables over HTTP on localhost
+or a Unix socket. Each variable is prepared once with the data class,
+regridded conservatively onto the construct_grid tiles so that grid ids
+index its columns directly, and saved as a .npy file that is memory mapped
+on later starts. Region lookups are kept once found.
+
+Requests that arrive together are answered in batches: every region in a
+batch is averaged with one gather and one segment sum per variable.
+
+Examples:
+    python service.py serve --data-dir ./data/meteorological --port 8765
+    curl "http://127.0.0.1:8765/timeseries?var=air&city=Berlin&country=Germany&months=12"
+    python service.py loadtest --port 8765 --requests 2000 --concurrency 32
+"""
+
+# Import modules
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
+import numpy as np
+import pandas as pd
+import cache
+import grid
+import regrid
+import variables
+
+# The statistics module lives with the NCEP surface variables, and is
+# loaded from its file so that sys.path isn't changed on import
+STATS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../variables/ncep/surface/stats.py")
+_stats_spec = importlib.util.spec_from_file_location("stats", STATS_PATH)
+stats = importlib.util.module_from_spec(_stats_spec)
+_stats_spec.loader.exec_module(stats)
+
+# Status lines of the HTTP responses the service sends
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+# Names of the variables inside NCEP files whose file name differs
+VARIABLE_NAMES = {"pres.sfc": "pres"}
+
+
+def variable_name(var: str) -> str:
+    """Find the name of the variable inside an NCEP monthly file.
+
+    Args:
+        var (str): the name of the NCEP variable's file, like pres.sfc.
+
+    Returns:
+        str: the name of the variable in the file, like pres.
+    """
+    return VARIABLE_NAMES.get(var, var)
+
+
+class QueryError(Exception):
+    """Error in a query, reported to the client with an HTTP status."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class ResidentVariable:
+    """A variable regridded onto the grid tiles and held in memory."""
+
+    def __init__(self, time: pd.DatetimeIndex, values: np.ndarray, dataset, signature: tuple):
+        """Initialize the resident variable.
+
+        Args:
+            time (pd.DatetimeIndex): the time of each row.
+            values (np.ndarray): a (time, grid id) array, usually memory
+                mapped.
+            dataset (xarray.Dataset): the prepared dataset on its own grid,
+                used to interpolate to points.
+            signature (tuple): the signature of the data file it was loaded
+                from, used to notice when the file is downloaded again.
+        """
+        self.time = time
+        self.values = values
+        self.dataset = dataset
+        self.signature = signature
+        self.months = np.asarray(time.month)
+
+
+class QueryService:
+    """Class for answering time series and climatology queries."""
+
+    def __init__(
+        self,
+        data_dir: str = "./data/meteorological",
+        shp_dir: str = "./data/shapefiles/",
+        cache_dir: str = "./data/service/",
+        gridspacing: float = 2.5,
+        batch_window: float = 0.002,
+        max_batch: int = 256,
+    ):
+        """Initialize the query service.
+
+        Args:
+            data_dir (str): the directory holding the NCEP monthly files.
+            shp_dir (str): the directory holding the shapefiles.
+            cache_dir (str): the directory for the memory mapped arrays and
+                regridding weights.
+            gridspacing (float): the spacing of the grid tiles in degrees,
+                matching the spatial join CSVs.
+            batch_window (float): the time in seconds to wait for more
+                requests to join a batch.
+            max_batch (int): the largest number of requests in a batch.
+        """
+        # Set the class properties
+        self.var_data = variables.data(data_dir)
+        self.shp_dir = shp_dir
+        self.cache_dir = cache_dir
+        self.gridspacing = gridspacing
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+
+        # Variables and region lookups kept in memory
+        self.resident = {}
+        self.regions = {}
+        self._lock = threading.Lock()
+        self._queue = None
+
+    def load_variable(self, var: str) -> ResidentVariable:
+        """Get a variable on the grid tiles, loading it on first use.
+
+        The data file is checked on every call, and the variable is loaded
+        again if the file has been downloaded again since it was loaded.
+
+        Args:
+            var (str): the name of the NCEP variable.
+
+        Returns:
+            ResidentVariable: the variable held in memory.
+        """
+        file_path = f"{self.var_data.dataDir}/{var}.mon.mean.nc"
+        with self._lock:
+            try:
+                signature = cache.file_signature(file_path)
+            except FileNotFoundError:
+                raise QueryError(f"No data for variable {var}.", status=404)
+            resident = self.resident.get(var)
+            if resident is not None and resident.signature == signature:
+                return resident
+
+            # Prepare the dataset the same way as the one-shot scripts
+            dataset = self.var_data.prepare_data(var)
+
+            # Regrid once per file version, then memory map the result
+            name = variable_name(var)
+            _, mtime, _ = signature
+            array_path = os.path.join(self.cache_dir, f"{var}_{self.gridspacing}_{mtime}.npy")
+            if not os.path.exists(array_path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                regridder = regrid.Regridder.to_gridspacing(
+                    dataset[[name]], self.gridspacing, weights_dir=self.cache_dir
+                )
+                tiles = regridder(dataset[[name]])[name].transpose("time", "lat", "lon")
+                values = np.asarray(tiles.values, dtype=np.float32).reshape(tiles.sizes["time"], -1)
+
+                # Write to a temporary file first, so an interrupted run
+                # never leaves a truncated array behind
+                handle, temp_path = tempfile.mkstemp(suffix=".npy", dir=self.cache_dir)
+                with os.fdopen(handle, "wb") as temp_file:
+                    np.save(temp_file, values)
+                os.replace(temp_path, array_path)
+            values = np.load(array_path, mmap_mode="r")
+
+            self.resident[var] = ResidentVariable(
+                pd.DatetimeIndex(dataset["time"].values), values, dataset, signature
+            )
+
+            return self.resident[var]
+
+    def warm(self, var_list=None):
+        """Load variables ahead of the first query.
+
+        A variable that fails to load is reported and skipped, so the other
+        variables can still be served.
+
+        Args:
+            var_list (list): the variables to load, or None for every
+                variable with a data file.
+        """
+        for var in var_list or self.var_data.varList:
+            if os.path.exists(f"{self.var_data.dataDir}/{var}.mon.mean.nc"):
+                try:
+                    self.load_variable(var)
+                except Exception as error:
+                    print(f"Could not load {var}: {error}", file=sys.stderr)
+
+    def region_ids(self, params: Dict[str, str]) -> np.ndarray:
+        """Find the grid ids of the region named in a query.
+
+        Args:
+            params (dict): the query parameters, with either city and
+                country, country, or lon and lat.
+
+        Returns:
+            np.ndarray: the grid ids of the region.
+        """
+        if "lon" in params and "lat" in params:
+            try:
+                lon, lat = float(params["lon"]), float(params["lat"])
+            except ValueError:
+                raise QueryError("lon and lat must be numbers.")
+            return np.array([grid.find_point_grid_id(lon, lat, self.gridspacing)])
+
+        if "city" in params and "country" in params:
+            key = ("city", params["city"], params["country"])
+        elif "country" in params:
+            key = ("country", params["country"])
+        else:
+            raise QueryError("Give city and country, country, or lon and lat.")
+
+        # Look up the region once and keep its grid ids
+        with self._lock:
+            if key not in self.regions:
+                try:
+                    if key[0] == "city":
+                        grid_list = grid.find_city_name_grids(key[1], key[2], self.shp_dir)
+                    else:
+                        grid_list = grid.find_country_name_grids(key[1], self.shp_dir)
+                except IndexError:
+                    raise QueryError(f"No region found for {' '.join(key[1:])}.", status=404)
+                self.regions[key] = np.array(grid_list, dtype=np.int64)
+
+            return self.regions[key]
+
+    def _interpolated_series(self, resident: ResidentVariable, var: str, params: Dict[str, str]) -> np.ndarray:
+        """Interpolate a variable to a point on its own grid."""
+        point = stats.VariableDataset(resident.dataset).interpolate_dataset_to_lat_lon(
+            float(params["lon"]), float(params["lat"])
+        )
+
+        return np.asarray(point[variable_name(var)].values, dtype=np.float64)
+
+    def answer_batch(self, batch):
+        """Answer a batch of parsed queries.
+
+        The regions of all queries for the same variable are averaged with
+        one gather of their grid ids and one segment sum.
+
+        Args:
+            batch (list): (path, params) tuples.
+
+        Returns:
+            list: a (status, body) tuple for each query.
+        """
+        answers = [None] * len(batch)
+        by_var = {}
+        for i, (path, params) in enumerate(batch):
+            try:
+                if path not in ("/timeseries", "/climatology"):
+                    raise QueryError(f"Unknown path {path}.", status=404)
+                var = params.get("var", "air")
+                resident = self.load_variable(var)
+                if params.get("interpolate") in ("1", "true") and "lon" in params:
+                    answers[i] = (path, params, resident, self._interpolated_series(resident, var, params))
+                    continue
+                region = self.region_ids(params)
+
+                # An empty region would share its segment with the next one
+                if region.size == 0:
+                    raise QueryError("No grid tiles found for the region.", status=404)
+                by_var.setdefault(var, []).append((i, region))
+            except QueryError as error:
+                answers[i] = (error.status, {"error": str(error)})
+            except (KeyError, ValueError) as error:
+                answers[i] = (400, {"error": str(error)})
+            except Exception as error:
+                answers[i] = (500, {"error": str(error)})
+
+        # Average every region for a variable at once
+        for var, queries in by_var.items():
+            try:
+                resident = self.resident[var]
+                ids = np.concatenate([region for _, region in queries])
+                starts = np.cumsum([0] + [region.size for _, region in queries[:-1]])
+                sums = np.add.reduceat(resident.values[:, ids].astype(np.float64), starts, axis=1)
+                means = sums / np.array([region.size for _, region in queries])
+            except Exception as error:
+                for i, _ in queries:
+                    answers[i] = (500, {"error": str(error)})
+                continue
+            for column, (i, _) in enumerate(queries):
+                path, params = batch[i]
+                answers[i] = (path, params, resident, means[:, column])
+
+        # Build the response of each query on its own
+        for i, answer in enumerate(answers):
+            if isinstance(answer[0], int):
+                continue
+            try:
+                answers[i] = self._format(*answer)
+            except Exception as error:
+                answers[i] = (500, {"error": str(error)})
+
+        return answers
+
+    def _format(self, path: str, params: Dict[str, str], resident: ResidentVariable, series: np.ndarray):
+        """Build the response body for a region's full time series."""
+        var = params.get("var", "air")
+
+        if path == "/timeseries":
+            try:
+                months = int(params.get("months", 12))
+            except ValueError:
+                return 400, {"error": "months must be an integer."}
+            if months < 1:
+                return 400, {"error": "months must be at least 1."}
+            time_values = resident.time[-months:]
+            return 200, {
+                "var": var,
+                "time": [str(value.date()) for value in time_values],
+                "values": _to_list(series[-months:]),
+            }
+
+        # Monthly means and standard deviations, like data.monthly_means
+        frame = pd.DataFrame({"value": series, "month": resident.months})
+        grouped = frame.groupby("month")["value"]
+        return 200, {
+            "var": var,
+            "month": grouped.mean().index.tolist(),
+            "avg": _to_list(grouped.mean().to_numpy()),
+            "std": _to_list(grouped.std().to_numpy()),
+        }
+
+    async def query(self, path: str, params: Dict[str, str]):
+        """Queue a query for the next batch and wait for its answer.
+
+        Args:
+            path (str): the query path, /timeseries or /climatology.
+            params (dict): the query parameters.
+
+        Returns:
+            tuple: the HTTP status and the response body.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((path, params, future))
+
+        return await future
+
+    async def _batcher(self):
+        """Collect queued queries into batches and answer them."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+
+            # Wait briefly for more queries to join the batch
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Answer the batch off the event loop
+            try:
+                answers = await loop.run_in_executor(
+                    None, self.answer_batch, [(path, params) for path, params, _ in batch]
+                )
+            except Exception as error:
+                answers = [(500, {"error": str(error)})] * len(batch)
+            for (_, _, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer HTTP GET requests on a connection until it is closed."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # Parse the request and answer it
+                parts = request_line.decode("latin-1").split()
+                if len(parts) < 2 or parts[0] != "GET":
+                    status, body = 400, {"error": "Only GET requests are supported."}
+                else:
+                    url = urlsplit(parts[1])
+                    if url.path == "/health":
+                        status, body = 200, {"status": "ok", "variables": sorted(self.resident)}
+                    else:
+                        status, body = await self.query(url.path, dict(parse_qsl(url.query)))
+
+                # Send the JSON response
+                payload = json.dumps(body).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, unix_path: Optional[str] = None):
+        """Serve queries until cancelled.
+
+        Args:
+            host (str): the address to listen on.
+            port (int): the port to listen on.
+            unix_path (str): the path of a Unix socket to listen on instead
+                of a TCP port.
+        """
+        self._queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._batcher())
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def _to_list(values: np.ndarray) -> list:
+    """Convert an array to a JSON list, with None for missing values."""
+    return [None if np.isnan(value) else round(float(value), 4) for value in values]
+
+
+async def load_test(
+    path: str = "/timeseries?var=air&lon=13.4&lat=52.5&months=12",
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    n_requests: int = 1000,
+    concurrency: int = 16,
+) -> Dict[str, float]:
+    """Send requests to a running service and measure their latency.
+
+    Args:
+        path (str): the request path and query.
+        host (str): the address of the service.
+        port (int): the port of the service.
+        n_requests (int): the total number of requests.
+        concurrency (int): the number of connections sending requests.
+
+    Returns:
+        dict: the throughput and the median and 99th percentile latency.
+    """
+    latencies = []
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode("latin-1")
+
+    async def client(n: int):
+        reader, writer = await asyncio.open_connection(host, port)
+        for _ in range(n):
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    counts = [n_requests // concurrency + (i < n_requests % concurrency) for i in range(concurrency)]
+    await asyncio.gather(*(client(n) for n in counts if n))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests_per_second": len(latencies) / elapsed,
+        "median_ms": float(np.median(latencies)) * 1000,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1000,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local weather query service.")
+    parser.add_argument("command", choices=["serve", "loadtest"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-path")
+    parser.add_argument("--data-dir", default="./data/meteorological")
+    parser.add_argument("--shp-dir", default="./data/shapefiles/")
+    parser.add_argument("--path", default="/timeseries?var=air&lon=13.4&lat=52.5&months=12")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        service = QueryService(data_dir=args.data_dir, shp_dir=args.shp_dir)
+        service.warm()
+        asyncio.run(service.serve(args.host, args.port, args.unix_path))
+    else:
+        print(asyncio.run(load_test(args.path, args.host, args.port, args.requests, args.concurrency)))
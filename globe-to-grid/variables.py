@@ -2,12 +2,11 @@
 # Convert monthly average meteorological values to grid
 
 # Import modules
-import xarray
-import pandas as pd
-import geopandas as gpd
-import grid
-import matplotlib.pyplot as plt
+# Pandas, matplotlib and the grid module are imported where they are used,
+# so downloading data doesn't wait on the plotting and geospatial imports
+import os
 import urllib.request
+import cache
 
 class download:
 
@@ -37,8 +36,12 @@ class download:
         baseUrl = "https://downloads.psl.noaa.gov/Datasets/ncep.reanalysis.derived/surface"
         fileUrl = f"{baseUrl}/{var}.mon.mean.nc"
 
-        # Download the file
-        urllib.request.urlretrieve(fileUrl, filePath)
+        # Download to a temporary file, so the old file is only replaced
+        # once the new one is complete, and drop any cached copy of it
+        tempPath = f"{filePath}.tmp"
+        urllib.request.urlretrieve(fileUrl, tempPath)
+        cache.invalidate(filePath)
+        os.replace(tempPath, filePath)
 
         return filePath
 
@@ -80,8 +83,8 @@ class data():
 
         filePath = f"{self.dataDir}/{var}.mon.mean.nc"
         
-        # Open the dataset with xarray
-        ds = xarray.open_dataset(filePath)
+        # Open the dataset with xarray, reusing it if already open
+        ds = cache.open_dataset(filePath)
 
         return ds
 
@@ -171,11 +174,13 @@ class data():
                
     def merge_data_to_grid(self,ds,gridPath="./data/shapefiles/grid_2.5.shp"):
 
+        import pandas as pd
+
         # Convert the dataset to a dataframe
         df = ds.to_dataframe().reset_index()
 
         # Read in the grid index from shapefile
-        gdfGrid = gpd.read_file(gridPath)
+        gdfGrid = cache.read_file(gridPath)
 
         # Specific the grid index 
         gdfGrid['grid_id'] = gdfGrid.index
@@ -191,6 +196,8 @@ class data():
 
     def get_city_data_from_grid(self,dfGrid,columns,city,country,timeDim="month"):
 
+        import grid
+
         # Get the grid IDs for the city
         gridList = grid.find_city_name_grids(city,country)
 
@@ -223,6 +230,8 @@ class plot():
 
     def plot_past_year(self,var,dfGrid):
 
+        import matplotlib.pyplot as plt
+
         # # Limit data to just the last year
         # dsLastYearWind = self.last_year_data(dsWind)
 
@@ -7,7 +7,19 @@
 # Import modules
 import os
 import urllib.request
-import xarray
+from typing import TYPE_CHECKING
+
+# Xarray is only imported when a dataset is read, so that downloads don't
+# wait on it
+if TYPE_CHECKING:
+    import xarray
+
+# Share the dataset cache with the globe-to-grid modules when they are
+# importable, and otherwise open the files directly
+try:
+    import cache
+except ImportError:
+    cache = None
 
 
 class BaseVariable:
@@ -48,12 +60,17 @@ class BaseVariable:
         # Build the file URL
         file_url = f"{self.base_url}/{self.var_name}.mon.mean.nc"
 
-        # Download the file
-        urllib.request.urlretrieve(file_url, download_path)
+        # Download to a temporary file, so the old file is only replaced
+        # once the new one is complete, and drop any cached copy of it
+        temp_path = f"{download_path}.tmp"
+        urllib.request.urlretrieve(file_url, temp_path)
+        if cache is not None:
+            cache.invalidate(download_path)
+        os.replace(temp_path, download_path)
 
         return download_path
 
-    def read_dataset(self) -> xarray.Dataset:
+    def read_dataset(self) -> "xarray.Dataset":
         """Read the dataset from the file path using xarray.
 
         Returns:
@@ -62,8 +79,13 @@ class BaseVariable:
         # Set the file path to open
         dataset_path = f"{self.data_dir}/{self.var_name}.mon.mean.nc"
 
-        # Open the dataset with xarray
-        dataset = xarray.open_dataset(dataset_path)
+        # Open the dataset with xarray, reusing it if already open
+        if cache is not None:
+            dataset = cache.open_dataset(dataset_path)
+        else:
+            import xarray
+
+            dataset = xarray.open_dataset(dataset_path)
         self.dataset = dataset
 
         return dataset
@@ -0,0 +1,354 @@
+"""Stream the yearly daily OLR files into monthly, pentad and seasonal means.
+
+Each yearly file downloaded by olr.download_daily_files is read on its own,
+so memory use is bounded by a year of data per worker no matter how many
+years are processed. Years are handled in parallel across processes, and
+results are written out one year at a time.
+
+Two passes are made over the files. The first writes the monthly and pentad
+means for each year and accumulates a day-of-year climatology, and the second
+writes the daily anomalies relative to the smoothed climatology.
+"""
+
+# Import modules
+import glob
+import os
+import re
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional
+import numpy as np
+import pandas as pd
+import xarray
+
+# Seasons keyed by the month they start in
+SEASONS = {12: "DJF", 3: "MAM", 6: "JJA", 9: "SON"}
+
+# Start and end dates in the daily file names
+FILE_DATES = re.compile(r"_(\d{8})_(\d{8})\.nc$")
+
+
+def find_daily_files(data_dir: str) -> List[str]:
+    """Find the downloaded daily OLR files in time order.
+
+    Args:
+        data_dir (str): the directory containing the daily files.
+
+    Returns:
+        list: the paths to the yearly files, sorted by their start date.
+    """
+    # File names look like olr-daily_v01r02_19790101_19791231.nc, or
+    # olr-daily_v01r02-preliminary_20210101_20211231.nc for the current
+    # year, so sort on the start date rather than the whole name
+    file_list = glob.glob(os.path.join(data_dir, "olr-daily_*.nc"))
+
+    def start_date(file_path):
+        match = FILE_DATES.search(os.path.basename(file_path))
+        return (match.group(1) if match else "", file_path)
+
+    return sorted(file_list, key=start_date)
+
+
+def noleap_dayofyear(time: pd.DatetimeIndex) -> np.ndarray:
+    """Find the day of year on a 365 day calendar.
+
+    Days after February 28 in leap years are shifted back one day, so that
+    February 29 shares a day of year with February 28.
+
+    Args:
+        time (pd.DatetimeIndex): the daily time values.
+
+    Returns:
+        np.ndarray: the day of year, from 1 to 365.
+    """
+    time = pd.DatetimeIndex(time)
+    dayofyear = np.asarray(time.dayofyear)
+    after_feb_28 = np.asarray(time.is_leap_year) & (dayofyear > 59)
+
+    return dayofyear - after_feb_28.astype(int)
+
+
+def fill_missing_days(climatology: np.ndarray) -> np.ndarray:
+    """Fill missing days of a day-of-year climatology by interpolation.
+
+    Args:
+        climatology (np.ndarray): the climatology with day of year as the
+            first axis.
+
+    Returns:
+        np.ndarray: the climatology with missing days interpolated
+            periodically from the nearest days with data.
+    """
+    n_days = climatology.shape[0]
+    values = climatology.reshape(n_days, -1).copy()
+    days = np.arange(n_days)
+
+    # Only the cells with some, but not all, days missing need filling
+    missing = np.isnan(values)
+    for cell in np.flatnonzero(missing.any(axis=0) & ~missing.all(axis=0)):
+        valid = ~missing[:, cell]
+        values[~valid, cell] = np.interp(days[~valid], days[valid], values[valid, cell], period=n_days)
+
+    return values.reshape(climatology.shape)
+
+
+def smooth_climatology(climatology: np.ndarray, n_harmonics: int = 3) -> np.ndarray:
+    """Smooth a day-of-year climatology by keeping its leading harmonics.
+
+    Days of year with no data are filled by periodic linear interpolation
+    from the neighbouring days before smoothing, so that a single missing
+    day doesn't leave the whole smoothed climatology missing. Cells with no
+    data on any day are left missing.
+
+    Args:
+        climatology (np.ndarray): the raw climatology with day of year as
+            the first axis.
+        n_harmonics (int): the number of annual harmonics to keep in addition
+            to the mean.
+
+    Returns:
+        np.ndarray: the smoothed climatology.
+    """
+    climatology = fill_missing_days(climatology)
+    coefficients = np.fft.rfft(climatology, axis=0)
+    coefficients[n_harmonics + 1:] = 0
+
+    return np.fft.irfft(coefficients, n=climatology.shape[0], axis=0)
+
+
+def _bounded_map(executor: Executor, function: Callable, argument_lists: List[tuple], max_in_flight: int) -> Iterator:
+    """Map a function over arguments in order, with few tasks in flight.
+
+    Unlike Executor.map, which submits every task at once, only a bounded
+    number of tasks are submitted ahead of the result being consumed, so
+    the results held in memory don't grow with the number of tasks.
+
+    Args:
+        executor (Executor): the executor to run the tasks on.
+        function (callable): the function to call.
+        argument_lists (list): the tuple of arguments of each call.
+        max_in_flight (int): the largest number of unconsumed tasks.
+
+    Yields:
+        the result of each call, in order.
+    """
+    pending = deque()
+    for arguments in argument_lists:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, *arguments))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _output_path(out_dir: str, kind: str, var_name: str, year: int) -> str:
+    """Build the path to a yearly output file."""
+    return os.path.join(out_dir, f"{var_name}-{kind}_{year}.nc")
+
+
+def _summarize_year(file_path: str, out_dir: str, var_name: str) -> Dict:
+    """Write one year's monthly and pentad means and return its partial sums.
+
+    Args:
+        file_path (str): the path to the yearly daily file.
+        out_dir (str): the directory to write the output files to.
+        var_name (str): the name of the variable in the file.
+
+    Returns:
+        dict: the year, the monthly sums and counts, and the day-of-year sums
+            and counts used for the climatology.
+    """
+    with xarray.open_dataset(file_path) as dataset:
+        data_array = dataset[var_name].load()
+    year = int(data_array["time.year"][0])
+    values = data_array.values.astype(np.float64)
+    valid = np.isfinite(values)
+    filled = np.where(valid, values, 0.0)
+
+    # Monthly means
+    months = np.asarray(data_array["time.month"])
+    monthly_sums = np.stack([filled[months == month].sum(axis=0) for month in range(1, 13)])
+    monthly_counts = np.stack([valid[months == month].sum(axis=0) for month in range(1, 13)])
+    monthly = data_array.resample(time="MS").mean()
+    monthly.to_dataset(name=var_name).to_netcdf(_output_path(out_dir, "monthly-mean", var_name, year))
+
+    # Pentad means, with 73 five day pentads per year
+    dayofyear = noleap_dayofyear(data_array["time"].values)
+    pentad = (dayofyear - 1) // 5
+    pentad_starts = pd.Series(data_array["time"].values).groupby(pentad).min()
+    pentads = data_array.groupby(xarray.DataArray(pentad, dims="time", name="pentad")).mean()
+    pentads = pentads.rename(pentad="time").assign_coords(time=pentad_starts.values)
+    pentads.to_dataset(name=var_name).to_netcdf(_output_path(out_dir, "pentad-mean", var_name, year))
+
+    # Day-of-year sums for the climatology
+    doy_sums = np.zeros((365,) + values.shape[1:])
+    doy_counts = np.zeros((365,) + values.shape[1:])
+    np.add.at(doy_sums, dayofyear - 1, filled)
+    np.add.at(doy_counts, dayofyear - 1, valid)
+
+    return {
+        "year": year,
+        "monthly_sums": monthly_sums,
+        "monthly_counts": monthly_counts,
+        "doy_sums": doy_sums,
+        "doy_counts": doy_counts,
+    }
+
+
+def _write_anomalies(file_path: str, out_dir: str, var_name: str, climatology_path: str) -> str:
+    """Write one year's daily anomalies from the smoothed climatology.
+
+    Args:
+        file_path (str): the path to the yearly daily file.
+        out_dir (str): the directory to write the output file to.
+        var_name (str): the name of the variable in the file.
+        climatology_path (str): the path to the climatology file.
+
+    Returns:
+        str: the path to the anomaly file.
+    """
+    with xarray.open_dataset(file_path) as dataset, xarray.open_dataset(climatology_path) as climatology:
+        data_array = dataset[var_name].load()
+        smoothed = climatology[f"{var_name}_smoothed"].load()
+
+    # Subtract the climatology for each day of the year
+    dayofyear = xarray.DataArray(noleap_dayofyear(data_array["time"].values), dims="time")
+    anomaly = data_array - smoothed.sel(dayofyear=dayofyear).drop_vars("dayofyear")
+    anomaly.attrs = dict(data_array.attrs, long_name=f"Daily anomaly of {var_name}")
+
+    year = int(data_array["time.year"][0])
+    anomaly_path = _output_path(out_dir, "daily-anomaly", var_name, year)
+    anomaly.to_dataset(name=var_name).to_netcdf(anomaly_path)
+
+    return anomaly_path
+
+
+def aggregate_daily_files(
+    data_dir: str,
+    out_dir: str,
+    var_name: str = "olr",
+    n_harmonics: int = 3,
+    max_workers: Optional[int] = None,
+) -> Dict[str, str]:
+    """Aggregate the yearly daily files into means and anomalies.
+
+    Writes yearly monthly-mean, pentad-mean and daily-anomaly files, plus a
+    single seasonal-mean file and a day-of-year climatology file.
+
+    Args:
+        data_dir (str): the directory containing the daily files.
+        out_dir (str): the directory to write the output files to.
+        var_name (str): the name of the variable in the files.
+        n_harmonics (int): the number of annual harmonics kept when
+            smoothing the climatology.
+        max_workers (int): the number of processes to use, or None to use
+            every core.
+
+    Returns:
+        dict: the paths to the climatology and seasonal mean files.
+    """
+    file_list = find_daily_files(data_dir)
+    if not file_list:
+        raise FileNotFoundError(f"No daily files found in {data_dir}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Read the grid from the first file
+    with xarray.open_dataset(file_list[0]) as dataset:
+        coords = {"lat": dataset["lat"].values, "lon": dataset["lon"].values}
+        attrs = dataset[var_name].attrs
+
+    doy_sums, doy_counts = 0, 0
+    season_times, season_names, season_means = [], [], []
+    previous_december, previous_year = None, None
+
+    # Keep one year per worker in flight, so memory is bounded by the
+    # number of workers rather than the number of years
+    max_workers = max_workers or os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        # First pass, with results coming back in time order
+        summaries = _bounded_map(
+            executor,
+            _summarize_year,
+            [(file_path, out_dir, var_name) for file_path in file_list],
+            max_workers,
+        )
+        for summary in summaries:
+
+            # Accumulate the climatology
+            doy_sums = doy_sums + summary["doy_sums"]
+            doy_counts = doy_counts + summary["doy_counts"]
+
+            # Seasonal means, carrying December into the next year's DJF
+            # only if the files are for consecutive years
+            sums, counts = summary["monthly_sums"], summary["monthly_counts"]
+            if previous_year is None or summary["year"] != previous_year + 1:
+                previous_december = None
+            for start_month, season in SEASONS.items():
+                if start_month == 12:
+                    if previous_december is None:
+                        continue
+                    month_sums = [previous_december[0], sums[0], sums[1]]
+                    month_counts = [previous_december[1], counts[0], counts[1]]
+                    season_time = pd.Timestamp(summary["year"] - 1, 12, 1)
+                else:
+                    months = range(start_month - 1, start_month + 2)
+                    month_sums = [sums[month] for month in months]
+                    month_counts = [counts[month] for month in months]
+                    season_time = pd.Timestamp(summary["year"], start_month, 1)
+
+                # Only write seasons with data in all three months
+                if not all(month_count.any() for month_count in month_counts):
+                    continue
+                season_sum = sum(month_sums)
+                season_count = sum(month_counts)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    season_means.append(np.where(season_count > 0, season_sum / season_count, np.nan))
+                season_times.append(season_time)
+                season_names.append(season)
+            previous_december = (sums[11], counts[11]) if counts[11].any() else None
+            previous_year = summary["year"]
+
+        # Write the raw and smoothed climatology
+        with np.errstate(invalid="ignore", divide="ignore"):
+            climatology = np.where(doy_counts > 0, doy_sums / doy_counts, np.nan)
+        climatology_dataset = xarray.Dataset(
+            {
+                var_name: (("dayofyear", "lat", "lon"), climatology, attrs),
+                f"{var_name}_smoothed": (
+                    ("dayofyear", "lat", "lon"),
+                    smooth_climatology(climatology, n_harmonics),
+                    attrs,
+                ),
+            },
+            coords=dict(coords, dayofyear=np.arange(1, 366)),
+        )
+        climatology_path = os.path.join(out_dir, f"{var_name}-daily-climatology.nc")
+        climatology_dataset.to_netcdf(climatology_path)
+
+        # Second pass, writing the anomalies
+        list(_bounded_map(
+            executor,
+            _write_anomalies,
+            [(file_path, out_dir, var_name, climatology_path) for file_path in file_list],
+            max_workers,
+        ))
+
+    # Write the seasonal means
+    grid_shape = (coords["lat"].size, coords["lon"].size)
+    season_means = np.array(season_means).reshape((-1,) + grid_shape)
+    seasonal_dataset = xarray.Dataset(
+        {var_name: (("time", "lat", "lon"), season_means, attrs)},
+        coords=dict(coords, time=pd.DatetimeIndex(season_times), season=("time", season_names)),
+    )
+    seasonal_path = os.path.join(out_dir, f"{var_name}-seasonal-mean.nc")
+    seasonal_dataset.to_netcdf(seasonal_path)
+
+    return {"climatology": climatology_path, "seasonal": seasonal_path}
+
+
+if __name__ == "__main__":
+
+    # Aggregate the daily OLR files downloaded by olr.py
+    aggregate_daily_files("./data/", "./data/aggregated/")
@@ -1,14 +1,17 @@
 # Import modules
+# Requests and BeautifulSoup are imported where they are used, since
+# they're only needed to find the file names on the NCEI pages
 import os
 import urllib.request
-from bs4 import BeautifulSoup
-import requests
 
 def get_monthly_file_path():
 
     """Since the monthly averages file is overwritten with a new name
     each month, we need a way to extract the file directly"""
 
+    from bs4 import BeautifulSoup
+    import requests
+
     # Set the directory to search in
     baseUrl =  "https://www.ncei.noaa.gov/data/"+\
                "outgoing-longwave-radiation-monthly/access/"
@@ -48,6 +51,9 @@ def get_daily_file_paths(yearList):
 
     """Find the files, separated by year, for daily OLR data."""
 
+    from bs4 import BeautifulSoup
+    import requests
+
     # Set the base URL for the directory to parse files
     baseUrl = "https://www.ncei.noaa.gov/data/"+\
               "outgoing-longwave-radiation-daily/access/"